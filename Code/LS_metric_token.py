@@ -4,7 +4,8 @@ import numpy as np
 import torch
 from torch.utils.data import DataLoader
 from encoder_decoder import EncoderDecoder
-from lawsCOPY import get_laws_for_Copy, DatasetForCOPY
+from encoder import EncoderCache
+from lawsCOPY import get_laws_for_Copy, DatasetForCOPY, collate_for_COPY, batch_to_device
 
 
 def levenshtein_ratio_and_distance(s, t, ratio_calc = False):
@@ -53,27 +54,32 @@ use_cuda = torch.cuda.is_available()
 device = torch.device('cuda:0' if use_cuda else 'cpu')
 
 hidden_size = 185
+# the encoder outputs of identical inputs are reused (keyed by the encoder weights)
+encoder_cache = EncoderCache('/scratch/sgutjahr/cache/encoder')
 
 for i in range(4):
     
     model = f'/scratch/sgutjahr/log/LT_COPY_{i}.pt'
     checkpoint = torch.load(model, map_location=(device))
-    COPY = EncoderDecoder(model_path, device, hidden_size=hidden_size)
+    COPY = EncoderDecoder(model_path, device, hidden_size=hidden_size, encoder_cache=encoder_cache)
     COPY.load_state_dict(checkpoint['model_state_dict'])
+    COPY.eval()
 
     for se in ['train','val','test']:
         
         data = get_laws_for_Copy(path, se)
-        dataset = DatasetForCOPY(data, device)
-        loader = DataLoader(dataset, batch_size=1, shuffle=False)
+        dataset = DatasetForCOPY(data)
+        loader = DataLoader(dataset, batch_size=1, shuffle=False, collate_fn=collate_for_COPY)
 
         stats = []
         tokens = []
         print(f'\nLETS GO: {i} {se}')
 
-        for j, (input_,change_,target_) in enumerate(loader):
+        for j, batch in enumerate(loader):
 
-            output_log_probs, output_seqs = COPY(input_,change_)
+            input_,change_,target_ = batch_to_device(batch, device)
+            with torch.no_grad():
+                output_log_probs, output_seqs = COPY(input_,change_)
 
             tar = target_[0].cpu().numpy()
             out = output_seqs.squeeze(-1)[0].cpu().numpy()
@@ -82,7 +88,7 @@ for i in range(4):
             out_sep = np.where(out == 103)[0]
 
             if out_sep.shape == (0,):
-                out_sep = 512
+                out_sep = out.shape[0]
             else:
                 out_sep = out_sep[0]
 
@@ -90,7 +96,9 @@ for i in range(4):
             LD_r = levenshtein_ratio_and_distance(tar[:tar_sep],out[:out_sep],True)
 
             stats.append([LD, LD_r])
-            to = np.vstack((tar,out))
+            # target and output are padded to max_length again for the saved tokens
+            length = COPY.decoder.max_length
+            to = np.vstack((np.pad(tar, (0, length - tar.shape[0])),np.pad(out, (0, length - out.shape[0]))))
             tokens.append(to)
             print(f'Round: {j+1}')
         
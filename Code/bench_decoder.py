@@ -0,0 +1,91 @@
+# Imports
+import argparse
+import time
+
+import torch
+
+from decoder import DecoderState
+from utils import synchronize
+from encoder_decoder import EncoderDecoder
+
+
+# Mean time of one decoder step in ms.
+# hoisted=False rebuilds the DecoderState (concatenated inputs, presence masks) and the
+# pad mask with a loop over the batch in every step, as the decoder did before the DecoderState
+def time_steps(decoder, old, change, inputs_old, inputs_cha, targets, steps, vocab_ids=None, hoisted=True):
+
+    batch_size = old.shape[0]
+    pad_idx = int(decoder.to_vocab_index(vocab_ids, decoder.pad_to))
+    cls_idx = int(decoder.to_vocab_index(vocab_ids, decoder.cls_to))
+    hidden = torch.zeros(1, batch_size, decoder.hidden_size, device=old.device)
+    selective_read = torch.zeros(batch_size, 1, decoder.hidden_size, device=old.device)
+    sampled_idx = torch.full((batch_size, 1), cls_idx, dtype=torch.long, device=old.device)
+    pad = torch.ones(batch_size, dtype=torch.bool, device=old.device)
+    state = DecoderState(decoder, old, change, inputs_old, inputs_cha, vocab_ids)
+    targets = decoder.to_vocab_index(vocab_ids, targets)
+
+    synchronize(old.device)
+    took = time.time()
+    for step_idx in range(1, steps + 1):
+        if hoisted:
+            pad = targets[:, step_idx-1] != pad_idx
+        else:
+            state = DecoderState(decoder, old, change, inputs_old, inputs_cha, vocab_ids)
+            for k in range(batch_size):
+                pad[k] = not pad_idx == targets[k, step_idx-1:step_idx]
+        sampled_idx, _, hidden, selective_read = decoder.step(sampled_idx, hidden, state, selective_read, pad)
+    synchronize(old.device)
+
+    return (time.time() - took) / steps * 1000
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Per step latency of the copy decoder')
+
+    parser.add_argument('--model_path', type=str, default='/scratch/sgutjahr/log/ddp500_BERT_MLM_best.pt',
+                        help='MLM checkpoint the EncoderDecoder is built from.')
+
+    parser.add_argument('-bs', '--batch_size', type=int, default=3,
+                        help='number of examples in a batch')
+
+    parser.add_argument('--seq_length', type=int, default=512,
+                        help='Length of old and change.')
+
+    parser.add_argument('--steps', type=int, default=100,
+                        help='Number of timed decoder steps.')
+
+    parser.add_argument('--hidden_size', type=int, default=185,
+                        help='The hidden size of the GRU unit')
+
+    parser.add_argument('--restrict_vocab', action='store_true',
+                        help='Decode over the tokens of the batch only.')
+
+    args = parser.parse_args()
+
+    use_cuda = torch.cuda.is_available()
+    device = torch.device('cuda:0' if use_cuda else 'cpu')
+    torch.manual_seed(42)
+
+    encoder_decoder = EncoderDecoder(args.model_path, device, hidden_size=args.hidden_size)
+    encoder_decoder.eval()
+    decoder = encoder_decoder.decoder
+
+    # random laws, the decoder only sees the projected encoder outputs
+    shape = (args.batch_size, args.seq_length)
+    inputs_old = torch.randint(1000, decoder.vocab_size, shape, device=device)
+    inputs_cha = torch.randint(1000, decoder.vocab_size, shape, device=device)
+    targets = torch.randint(1000, decoder.vocab_size, (args.batch_size, args.steps + 1), device=device)
+    old = torch.randn(args.batch_size, args.seq_length, args.hidden_size, device=device)
+    change = torch.randn(args.batch_size, args.seq_length, args.hidden_size, device=device)
+    vocab_ids = decoder.batch_vocab(inputs_old, inputs_cha, targets) if args.restrict_vocab else None
+
+    with torch.no_grad():
+        # warm up
+        time_steps(decoder, old, change, inputs_old, inputs_cha, targets, 5, vocab_ids)
+        before = time_steps(decoder, old, change, inputs_old, inputs_cha, targets, args.steps, vocab_ids, hoisted=False)
+        after = time_steps(decoder, old, change, inputs_old, inputs_cha, targets, args.steps, vocab_ids, hoisted=True)
+
+    print(f'batch_size = {args.batch_size} | seq_length = {args.seq_length} | restrict_vocab = {args.restrict_vocab}')
+    print(f'Per step (rebuilt every step): {before:.3f} ms')
+    print(f'Per step (DecoderState):       {after:.3f} ms')
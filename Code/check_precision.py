@@ -0,0 +1,92 @@
+# Imports
+import argparse
+import sys
+import time
+
+import torch
+from torch.utils.data import DataLoader
+from transformers import AutoTokenizer
+
+from lawsCOPY import get_laws_for_Copy, DatasetForCOPY, collate_for_COPY, batch_to_device
+from encoder_decoder import EncoderDecoder
+from LS_metric import levenshtein_stats
+from utils import synchronize
+
+
+# Encoder latency (ms per copy pair) over the first num pairs of a loader
+def encoder_latency(COPY, loader, device, num):
+
+    took = 0.0
+    for i, batch in enumerate(loader):
+        if i == num:
+            break
+        input_, change_, _ = batch_to_device(batch, device)
+        with torch.no_grad():
+            # the kernels run asynchronously on the GPU
+            synchronize(device)
+            start = time.time()
+            COPY.encode(input_, change_)
+            synchronize(device)
+            took += time.time() - start
+    return took / max(min(num, len(loader)), 1) * 1000
+
+
+# Accuracy guard for the inference precisions (EncoderDecoder.set_precision):
+# Levenshtein distance of the fp32 and the reduced precision model on a validation slice,
+# exits with 1 if the mean relative distance grows by more than max_delta
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Levenshtein delta and encoder latency of int8/bf16/fp16 inference')
+
+    parser.add_argument('--checkpoint', type=str, default='/scratch/sgutjahr/log/FT_COPY_best.pt',
+                        help='Fine-tuned COPY checkpoint.')
+
+    parser.add_argument('--precision', type=str, default='int8', choices=['int8', 'bf16', 'fp16'],
+                        help='Precision that is compared with fp32.')
+
+    parser.add_argument('--kind', type=str, default='val',
+                        help='Split of the copy pairs.')
+
+    parser.add_argument('--num', type=int, default=100,
+                        help='Size of the validation slice.')
+
+    parser.add_argument('--max_delta', type=float, default=0.01,
+                        help='Largest allowed increase of the mean relative Levenshtein distance.')
+
+    parser.add_argument('--hidden_size', type=int, default=185,
+                        help='The hidden size of the GRU unit')
+
+    args = parser.parse_args()
+
+    pre = '/scratch/sgutjahr'
+    model_path = pre + '/log/ddp500_BERT_MLM_best.pt'
+    path = pre + '/Data_Token_Copy/'
+    tokenizer = AutoTokenizer.from_pretrained('dbmdz/bert-base-german-cased')
+    # int8 runs on the CPU only
+    use_cuda = torch.cuda.is_available() and args.precision != 'int8'
+    device = torch.device('cuda:0' if use_cuda else 'cpu')
+
+    data = get_laws_for_Copy(path, args.kind)
+    loader = DataLoader(DatasetForCOPY(data), batch_size=1, shuffle=False, collate_fn=collate_for_COPY)
+    checkpoint = torch.load(args.checkpoint, map_location=device)
+
+    results = {}
+    for precision in ['fp32', args.precision]:
+        COPY = EncoderDecoder(model_path, device, hidden_size=args.hidden_size)
+        COPY.load_state_dict(checkpoint['model_state_dict'])
+        COPY.set_precision(precision)
+        COPY.eval()
+
+        stats, _ = levenshtein_stats(COPY, loader, tokenizer, device, num=args.num, verbose=False)
+        latency = encoder_latency(COPY, loader, device, args.num)
+        results[precision] = (stats[:, 1].mean(), stats[:, 2].mean(), latency)
+        print(f'{precision:5s} | LD={results[precision][0]:.2f} | LD_rel={results[precision][1]:.4f} | '
+              f'encoder {latency:.1f} ms/pair', flush=True)
+
+    delta = results[args.precision][1] - results['fp32'][1]
+    speedup = results['fp32'][2] / results[args.precision][2]
+    print(f'\nDelta LD_rel: {delta:+.4f} (max {args.max_delta}) | Encoder speedup: {speedup:.2f}x')
+
+    if delta > args.max_delta:
+        print('Accuracy guard failed')
+        sys.exit(1)
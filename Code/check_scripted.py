@@ -0,0 +1,90 @@
+# Imports
+import argparse
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+from lawsCOPY import get_laws_for_Copy, DatasetForCOPY, collate_for_COPY, batch_to_device
+from encoder_decoder import EncoderDecoder
+
+
+# Compare the scripted greedy loop with the eager Decoder on the first num copy pairs of a split:
+# the sampled ids have to be the same, the log_probs equal up to tol
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Parity and latency of the scripted greedy decoder')
+
+    parser.add_argument('--checkpoint', type=str, default='/scratch/sgutjahr/log/FT_COPY_best.pt',
+                        help='Fine-tuned COPY checkpoint.')
+
+    parser.add_argument('--kind', type=str, default='test',
+                        help='Split of the copy pairs.')
+
+    parser.add_argument('--num', type=int, default=20,
+                        help='Number of copy pairs (batch size 1).')
+
+    parser.add_argument('--hidden_size', type=int, default=185,
+                        help='The hidden size of the GRU unit')
+
+    parser.add_argument('--warmup', type=int, default=2,
+                        help='Pairs that are not timed (scripting and the optimization of the TorchScript loop).')
+
+    parser.add_argument('--restrict_vocab', action='store_true',
+                        help='Decode over the tokens of old and change only.')
+
+    parser.add_argument('--tol', type=float, default=1e-4,
+                        help='Largest allowed difference of the log_probs.')
+
+    args = parser.parse_args()
+
+    path = '/scratch/sgutjahr/Data_Token_Copy/'
+    model_path = '/scratch/sgutjahr/log/ddp500_BERT_MLM_best.pt'
+    use_cuda = torch.cuda.is_available()
+    device = torch.device('cuda:0' if use_cuda else 'cpu')
+
+    COPY = EncoderDecoder(model_path, device, hidden_size=args.hidden_size)
+    checkpoint = torch.load(args.checkpoint, map_location=device)
+    COPY.load_state_dict(checkpoint['model_state_dict'])
+    COPY.eval()
+
+    data = get_laws_for_Copy(path, args.kind)
+    loader = DataLoader(DatasetForCOPY(data), batch_size=1, shuffle=False, collate_fn=collate_for_COPY)
+
+    time_eager = 0.0
+    time_scripted = 0.0
+    n_tokens = 0
+    failed = 0
+    for j, batch in enumerate(loader):
+        if j == args.num:
+            break
+        input_, change_, _ = batch_to_device(batch, device)
+        vocab_ids = None
+        if args.restrict_vocab:
+            vocab_ids = COPY.decoder.batch_vocab(input_['input_ids'], change_['input_ids'])
+
+        with torch.no_grad():
+            # the encoder is the same for both, only the decoder loop is timed
+            outputs_old, outputs_cha, inputs_old, inputs_cha = COPY.encode(input_, change_)
+            took = time.time()
+            eager_log_probs, eager_idxs = COPY.decoder(outputs_old, outputs_cha, inputs_old, inputs_cha,
+                                                       vocab_ids=vocab_ids)
+            took_eager = time.time() - took
+            took = time.time()
+            scripted_log_probs, scripted_idxs = COPY.decoder.scripted_greedy(outputs_old, outputs_cha, inputs_old,
+                                                                             inputs_cha, vocab_ids=vocab_ids)
+            took_scripted = time.time() - took
+
+        if j >= args.warmup:
+            time_eager += took_eager
+            time_scripted += took_scripted
+            n_tokens += int((eager_idxs != COPY.decoder.pad_to).sum())
+        diff = (eager_log_probs - scripted_log_probs).abs().max().item()
+        same = torch.equal(eager_idxs, scripted_idxs) and diff <= args.tol
+        failed += not same
+        print(f'Pair {j+1} | same ids: {torch.equal(eager_idxs, scripted_idxs)} | max diff log_probs: {diff:.2e}')
+
+    print(f'\nFailed: {failed}')
+    n_tokens = max(n_tokens, 1)
+    print(f'Eager:    {time_eager / n_tokens * 1000:.3f} ms/token')
+    print(f'Scripted: {time_scripted / n_tokens * 1000:.3f} ms/token')
@@ -1,6 +1,9 @@
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+from scripted_decoder import GreedyDecoder
 
 
 class Embedder(nn.Module):
@@ -13,21 +16,85 @@ class Embedder(nn.Module):
         # embedding_dim: 768
         self.embedding_dim = self.embeddings.position_embeddings.embedding_dim
         self.ff = nn.Linear(self.embedding_dim, self.hidden_size)
+        # projected embeddings of the whole vocab for inference, rebuilt when the weights changed
+        self._table = None
+        self._table_state = None
 
     def forward(self, input_ids):
+        if self.use_table(input_ids):
+            return F.embedding(input_ids, self.projected_table())
         outputs = self.embeddings(input_ids)
         outputs = self.ff(outputs)
         return outputs
 
+    def use_table(self, input_ids):
+        # the decoder embeds every token on its own (position 0, no dropout in eval mode),
+        # so the output only depends on the token id
+        return not self.training and not torch.is_grad_enabled() and input_ids.shape[-1] == 1
+
+    def projected_table(self, chunk_size=4096):
+        # table.shape = (vocab_size, hidden)
+        # recomputed when a parameter was changed in place (optimizer step, load_state_dict) or replaced
+        state = tuple((p.data_ptr(), p._version) for p in self.parameters())
+        if state != self._table_state:
+            vocab_size = self.embeddings.word_embeddings.num_embeddings
+            device = self.embeddings.word_embeddings.weight.device
+            ids = torch.arange(vocab_size, device=device).view(-1, 1)
+            self._table = torch.cat([self.ff(self.embeddings(chunk)).squeeze(1) for chunk in ids.split(chunk_size)])
+            self._table_state = state
+        return self._table
+
+
+class DecoderState:
+    # Everything of a batch that stays the same over the decoding steps, built once per decode.
+    # inputs_old/inputs_cha/input_seq are indices into vocab_ids if it is given.
+    def __init__(self, decoder, old, change, inputs_old, inputs_cha, vocab_ids=None):
+        assert old.shape[0] == change.shape[0]
+        assert old.shape[1] == change.shape[1]
+        self.vocab_ids = vocab_ids
+        self.n_vocab = decoder.vocab_size if vocab_ids is None else vocab_ids.shape[0]
+        mask_idx = decoder.to_vocab_index(vocab_ids, decoder.mask_to)
+        pad_idx = decoder.to_vocab_index(vocab_ids, decoder.pad_to)
+
+        # old.shape = (b, seq_length, hidden), inputs_old.shape = (b, seq_length)
+        self.old = old
+        self.change = change
+        self.inputs_old = decoder.to_vocab_index(vocab_ids, inputs_old.long())
+        self.inputs_cha = decoder.to_vocab_index(vocab_ids, inputs_cha.long())
+        # memory.shape = (b, 2*seq_length, hidden), input_seq.shape = (b, 2*seq_length)
+        self.memory = torch.cat((old, change), dim=1)
+        self.input_seq = torch.cat((self.inputs_old, self.inputs_cha), dim=1)
+
+        # tokens that are neither in old nor in change (+ MASK), the [PAD] column is set every step
+        # missing_token_mask.shape = (b, n_vocab)
+        self.missing_token_mask = torch.ones((old.shape[0], self.n_vocab), dtype=torch.bool, device=old.device)
+        self.missing_token_mask = self.missing_token_mask.scatter(1, self.input_seq, False)
+        self.missing_token_mask[:, mask_idx] = True
+        self.missing_token_mask[:, pad_idx] = False
+        # pad_column.shape = (1, n_vocab)
+        self.pad_column = torch.zeros((1, self.n_vocab), dtype=torch.bool, device=old.device)
+        self.pad_column[:, pad_idx] = True
+
+    def select(self, rows):
+        # state of the rows (bool mask or indices, e.g. the unfinished rows or the beams)
+        state = DecoderState.__new__(DecoderState)
+        state.vocab_ids, state.n_vocab, state.pad_column = self.vocab_ids, self.n_vocab, self.pad_column
+        for name in ['old', 'change', 'inputs_old', 'inputs_cha', 'memory', 'input_seq', 'missing_token_mask']:
+            setattr(state, name, getattr(self, name)[rows])
+        return state
+
 
 class Decoder(nn.Module):
-    def __init__(self, hidden_size, max_length, vocab_size, device, model_loaded, pad_to, cls_to, sep_to, mask_to):
+    def __init__(self, hidden_size, max_length, vocab_size, device, model_loaded, pad_to, cls_to, sep_to, mask_to,
+                 length_factor=2.0):
         super(Decoder, self).__init__()
         self.device = device
         self.hidden_size = hidden_size
         self.embedding = Embedder(model_loaded, self.hidden_size)
 
         self.max_length = max_length
+        # decoding steps at inference: length_factor * longest input of the batch (None -> max_length)
+        self.length_factor = length_factor
         self.vocab_size = vocab_size
         self.pad_to = pad_to
         self.cls_to = cls_to
@@ -43,147 +110,514 @@ class Decoder(nn.Module):
         self.gru = nn.GRU(4*self.hidden_size, self.hidden_size, batch_first=True)
         self.out = nn.Linear(self.hidden_size, self.vocab_size)
 
+        # scripted greedy loops (see scripted_greedy) per device, not part of the state_dict
+        self._scripted = {}
+        # training with teacher_forcing=1.0 and targets runs teacher_forced (all steps at once, approximated)
+        # instead of the loop
+        self.parallel_teacher_forcing = False
+        # > 0: with targets the steps run in segments of checkpoint_every steps whose activations
+        # are recomputed in the backward pass (see forward_targets), 0 -> off
+        self.checkpoint_every = 0
+
+
+    def forward(self, old, change, inputs_old, inputs_cha, targets=None, teacher_forcing=1.0, vocab_ids=None,
+                return_log_probs=True):
+        # vocab_ids: optional sorted token ids (see batch_vocab) the decoder is restricted to.
+        # The log_probs are then over vocab_ids instead of the full vocab,
+        # the sampled_idxs are always global token ids.
+        # return_log_probs=False (with targets): the NLL of the targets is summed up step by step
+        # and returned instead of the (b, steps, n_vocab) log_probs -> (loss, sampled_idxs)
+
+        # training only: validation and inference always run the exact step loop
+        if (targets is not None and teacher_forcing >= 1.0 and self.parallel_teacher_forcing
+                and self.training and torch.is_grad_enabled()):
+            return self.teacher_forced(old, change, inputs_old, inputs_cha, targets, vocab_ids, return_log_probs)
+        if targets is not None:
+            return self.forward_targets(old, change, inputs_old, inputs_cha, targets, teacher_forcing, vocab_ids,
+                                        return_log_probs)
 
-    def forward(self, old, change, inputs_old, inputs_cha, targets=None, teacher_forcing=1.0):
-    
         batch_size = old.shape[0]
+        max_steps = self.decode_length(inputs_old, inputs_cha)
+        n_vocab = self.vocab_size if vocab_ids is None else vocab_ids.shape[0]
+        cls_idx = int(self.to_vocab_index(vocab_ids, self.cls_to))
+        pad_idx = int(self.to_vocab_index(vocab_ids, self.pad_to))
+        sep_idx = self.to_vocab_index(vocab_ids, self.sep_to)
 
         # Set initial hidden states
         hidden = torch.zeros(1, batch_size, self.hidden_size).to(self.device)
 
-        sos_output = torch.zeros((batch_size, self.vocab_size)).to(self.device)
-        sos_output[:, self.cls_to] = 1.0
+        sos_output = torch.zeros((batch_size, n_vocab)).to(self.device)
+        sos_output[:, cls_idx] = 1.0
         # every seq stars with a CLS token
-        sampled_idx = torch.tensor([[self.cls_to] for x in range(batch_size)]).long().to(self.device)
-
-        decoder_outputs = [sos_output]
-        sampled_idxs = [sampled_idx]
+        sampled_idx = torch.tensor([[cls_idx] for x in range(batch_size)]).long().to(self.device)
 
         # Set initial selective-read states
         selective_read = torch.zeros(batch_size, 1, self.hidden_size).to(self.device)
-        # ohis = (b, seq_length, vocab_size)
-        one_hot_input_seq_old = self.to_one_hot(inputs_old, self.vocab_size)
-        one_hot_input_seq_cha = self.to_one_hot(inputs_cha, self.vocab_size)
-        
+        # the step invariant parts (concatenated inputs, masks) are computed once
+        state = DecoderState(self, old, change, inputs_old, inputs_cha, vocab_ids)
+
         pad = torch.tensor([True]*batch_size , requires_grad=False).to(self.device)
 
-        for step_idx in range(1, self.max_length):
+        # greedy decoding: rows that emitted [SEP] drop out of the batch, stop when all are done
+        # the outputs keep the shape (b, max_steps, ...), finished rows are filled with [PAD]
+        active = torch.arange(batch_size, device=self.device)
+        decoder_outputs = sos_output.new_zeros((batch_size, max_steps, n_vocab))
+        decoder_outputs[:, 0] = sos_output
+        sampled_idxs = torch.full((batch_size, max_steps, 1), pad_idx, dtype=torch.long, device=self.device)
+        sampled_idxs[:, 0] = sampled_idx
+
+        for step_idx in range(1, max_steps):
+
+            sampled_idx, output, hidden, selective_read = self.step(sampled_idx, hidden, state, selective_read, pad)
+
+            decoder_outputs[active, step_idx] = output
+            sampled_idxs[active, step_idx] = sampled_idx
+
+            # running.shape = (active,)
+            running = (sampled_idx != sep_idx).view(-1)
+            if not running.all():
+                if not running.any():
+                    break
+                # shrink the active batch to the unfinished rows
+                active = active[running]
+                sampled_idx = sampled_idx[running]
+                hidden = hidden[:, running]
+                selective_read = selective_read[running]
+                state = state.select(running)
+                pad = pad[running]
+
+        if vocab_ids is not None:
+            # map back to the global token ids
+            sampled_idxs = vocab_ids[sampled_idxs]
+
+        return decoder_outputs, sampled_idxs
+
+
+    def forward_targets(self, old, change, inputs_old, inputs_cha, targets, teacher_forcing=1.0, vocab_ids=None,
+                        return_log_probs=True):
+        # forward with targets: the steps run as segments (see segment), all steps in one segment or,
+        # with checkpoint_every > 0 while training, segments of checkpoint_every steps whose activations
+        # are not kept but recomputed in the backward pass (the RNG state of the teacher forcing and dropout
+        # is restored), only the hidden state, the selective read and the outputs of every segment stay in memory
 
-            if not targets == None and step_idx < targets.shape[1]:
+        batch_size = old.shape[0]
+        max_steps = self.decode_length(inputs_old, inputs_cha, targets)
+        state = DecoderState(self, old, change, inputs_old, inputs_cha, vocab_ids)
+        cls_idx = int(self.to_vocab_index(vocab_ids, self.cls_to))
+        pad_idx = int(self.to_vocab_index(vocab_ids, self.pad_to))
+        targets = self.to_vocab_index(vocab_ids, targets.long())
+        stream_loss = not return_log_probs
+
+        hidden = old.new_zeros((1, batch_size, self.hidden_size))
+        selective_read = old.new_zeros((batch_size, 1, self.hidden_size))
+        # every seq stars with a CLS token
+        sampled_idx = torch.full((batch_size, 1), cls_idx, dtype=torch.long, device=old.device)
+        pad = torch.ones(batch_size, dtype=torch.bool, device=old.device)
+        sos_output = old.new_zeros((batch_size, state.n_vocab))
+        sos_output[:, cls_idx] = 1.0
+
+        nll_sum = self.sos_nll(sos_output, targets, pad_idx)
+        decoder_outputs = [sos_output.unsqueeze(1)]
+        sampled_idxs = [sampled_idx.unsqueeze(1)]
+
+        checkpointed = self.checkpoint_every > 0 and torch.is_grad_enabled()
+        segment_length = self.checkpoint_every if checkpointed else max(max_steps - 1, 1)
+        for start in range(1, max_steps, segment_length):
+            end = min(start + segment_length, max_steps)
+            args = (start, end, sampled_idx, hidden, selective_read, pad, state, targets, teacher_forcing, stream_loss)
+            if checkpointed:
+                outputs = checkpoint(self.segment, *args, use_reentrant=False)
+            else:
+                outputs = self.segment(*args)
+            sampled_idx, hidden, selective_read, pad, outputs, idxs = outputs
+            if stream_loss:
+                nll_sum = nll_sum + outputs
+            else:
+                decoder_outputs.append(outputs)
+            sampled_idxs.append(idxs)
+
+        sampled_idxs = torch.cat(sampled_idxs, dim=1)
+        if vocab_ids is not None:
+            # map back to the global token ids
+            sampled_idxs = vocab_ids[sampled_idxs]
+        if stream_loss:
+            return nll_sum / (targets != pad_idx).sum(), sampled_idxs
+        return torch.cat(decoder_outputs, dim=1), sampled_idxs
+
+
+    def segment(self, start, end, sampled_idx, hidden, selective_read, pad, state, targets, teacher_forcing,
+                stream_loss):
+        # the steps start..end-1 of forward with targets
+        # -> the recurrent state after the segment, the NLL sum (stream_loss) or the log_probs (b, steps, n_vocab)
+        # and the sampled_idxs (b, steps, 1) of the segment
+        batch_size = sampled_idx.shape[0]
+        pad_idx = int(self.to_vocab_index(state.vocab_ids, self.pad_to))
+        nll_sum = hidden.new_zeros(())
+        outputs = []
+        idxs = []
+
+        for step_idx in range(start, end):
+
+            if step_idx < targets.shape[1]:
                 # replace some inputs with the targets (i.e. teacher forcing)
-                for k in range(batch_size):
-                    pad[k] = not self.pad_to == targets[k, step_idx-1:step_idx]
-                
+                pad = targets[:, step_idx-1] != pad_idx
                 teacher_forcing_mask = ((torch.rand((batch_size, 1)) < teacher_forcing)).detach().to(self.device)
                 sampled_idx = sampled_idx.masked_scatter(teacher_forcing_mask, targets[:, step_idx-1:step_idx])
 
-            sampled_idx, output, hidden, selective_read = self.step(sampled_idx, hidden, old, change, selective_read,
-                                                                    one_hot_input_seq_old, one_hot_input_seq_cha, pad)
-            
+            sampled_idx, output, hidden, selective_read = self.step(sampled_idx, hidden, state, selective_read, pad,
+                                                                    return_probs=stream_loss)
+            idxs.append(sampled_idx)
+            if not stream_loss:
+                outputs.append(output)
+            elif step_idx < targets.shape[1]:
+                # -log(p + 10**-10) of the target token, only the probs of this step are kept for backward
+                target_probs = output.gather(1, targets[:, step_idx:step_idx+1]).squeeze(1)
+                nll_sum = nll_sum - (torch.log(target_probs + 10**-10) * (targets[:, step_idx] != pad_idx)).sum()
+
+        outputs = nll_sum if stream_loss else torch.stack(outputs, dim=1)
+        return sampled_idx, hidden, selective_read, pad, outputs, torch.stack(idxs, dim=1)
 
-            decoder_outputs.append(output)
-            sampled_idxs.append(sampled_idx)
 
-        decoder_outputs = torch.stack(decoder_outputs, dim=1)
-        sampled_idxs = torch.stack(sampled_idxs, dim=1)
+    @staticmethod
+    def sos_nll(sos_output, targets, pad_idx):
+        # NLL of the [CLS] step, same value as NLLLoss(ignore_index=[PAD]) over the stacked outputs:
+        # the [CLS] step counts its sos_output (1.0) as log prob there
+        return -(sos_output.gather(1, targets[:, :1]).squeeze(1) * (targets[:, 0] != pad_idx)).sum()
 
+
+    def teacher_forced(self, old, change, inputs_old, inputs_cha, targets, vocab_ids=None, return_log_probs=True):
+        # forward with teacher_forcing=1.0 without the step loop: the inputs of every step are the targets,
+        # so the GRU runs as one sequence call and attention/copy scores of all steps are batched matmuls.
+        # Only hidden and selective read are recurrent, they are approximated by a first GRU pass over the
+        # embedded targets alone (no context, no selective read): its outputs are the attention queries and
+        # give the copy scores of the selective reads, which are taken of the teacher tokens (not the argmax).
+        # Same outputs/loss as forward otherwise, (b, steps, n_vocab) log_probs or the NLL and the sampled_idxs
+
+        batch_size = old.shape[0]
+        max_steps = self.decode_length(inputs_old, inputs_cha, targets)
+        steps = max_steps - 1
+        state = DecoderState(self, old, change, inputs_old, inputs_cha, vocab_ids)
+        cls_idx = int(self.to_vocab_index(vocab_ids, self.cls_to))
+        pad_idx = int(self.to_vocab_index(vocab_ids, self.pad_to))
+        targets = self.to_vocab_index(vocab_ids, targets.long())
+        seq_length = old.shape[1]
+
+        sos_output = old.new_zeros((batch_size, state.n_vocab))
+        sos_output[:, cls_idx] = 1.0
+
+        # inputs of the steps 1..steps: [CLS] is targets[:, 0], pad.shape = (b, steps)
+        prev_idxs = targets[:, :steps]
+        pad = prev_idxs != pad_idx
+        # every token on its own at position 0 as in the step loop
+        # embedded.shape = (b, steps, hidden)
+        embedded = self.embedding((prev_idxs if vocab_ids is None else vocab_ids[prev_idxs]).reshape(-1, 1))
+        embedded = embedded.view(batch_size, steps, self.hidden_size)
+        if hasattr(self.gru, 'flatten_parameters'):
+            self.gru.flatten_parameters()
+
+        # draft pass, draft.shape = (b, steps, hidden)
+        zeros = embedded.new_zeros((batch_size, steps, 3 * self.hidden_size))
+        draft, _ = self.gru(torch.cat((zeros, embedded), dim=2))
+        # queries.shape = (b, steps, hidden) -> the hidden state before every step (zeros before the first)
+        queries = torch.cat((embedded.new_zeros((batch_size, 1, self.hidden_size)), draft[:, :-1]), dim=1)
+
+        # ATTENTION for all steps, separately for old and change
+        # attn_weights.shape = (b, 2, steps, seq_length)
+        attn_scores = torch.bmm(self.attn_W(queries), state.memory.transpose(1, 2))
+        attn_weights = F.softmax(attn_scores.view(batch_size, steps, 2, seq_length).transpose(1, 2), dim=3)
+        # context.shape = (b, steps, 2*hidden)
+        context = torch.matmul(attn_weights, state.memory.view(batch_size, 2, seq_length, self.hidden_size))
+        context = context.transpose(1, 2).reshape(batch_size, steps, 2 * self.hidden_size)
+
+        # selective read of the token fed at step t with the copy scores of the draft at step t-1
+        # draft_scores.shape = (b, steps-1, 2*seq_length)
+        draft_scores = torch.bmm(self.copy_W(draft[:, :-1]), state.memory.transpose(1, 2))
+        selected = (state.input_seq.unsqueeze(1) == prev_idxs[:, 1:].unsqueeze(2)).to(draft_scores.dtype)
+        selected_norm = F.normalize(selected * draft_scores, p=1, dim=2)
+        # selective_read.shape = (b, steps, hidden)
+        selective_read = torch.cat((embedded.new_zeros((batch_size, 1, self.hidden_size)),
+                                    torch.bmm(selected_norm, state.memory)), dim=1)
+
+        # GRU over all steps, outputs.shape = (b, steps, hidden)
+        outputs, _ = self.gru(torch.cat((context, selective_read, embedded), dim=2))
+
+        # COPY scores of all steps, copy_scores.shape = (b, steps, 2*seq_length)
+        copy_scores = torch.bmm(self.copy_W(outputs), state.memory.transpose(1, 2))
+        # combined_scores.shape = (b, steps, n_vocab)
+        # in fp32 under autocast as in score
+        combined_scores = copy_scores.new_zeros((batch_size, steps, state.n_vocab), dtype=torch.float)
+        combined_scores = combined_scores.scatter_add(2, state.input_seq.unsqueeze(1).expand(-1, steps, -1),
+                                                      copy_scores.float())
+        missing_token_mask = state.missing_token_mask.unsqueeze(1) | (state.pad_column.unsqueeze(1) & pad.unsqueeze(2))
+        combined_scores = combined_scores.masked_fill(missing_token_mask, -2000000.0)
+        probs = F.softmax(combined_scores, dim=2)
+
+        # sampled_idxs.shape = (b, max_steps, 1)
+        cls_column = torch.full((batch_size, 1), cls_idx, dtype=torch.long, device=old.device)
+        sampled_idxs = torch.cat((cls_column, probs.argmax(dim=2)), dim=1).unsqueeze(2)
+        if vocab_ids is not None:
+            sampled_idxs = vocab_ids[sampled_idxs]
+
+        if not return_log_probs:
+            # NLL as the streamed loss of forward
+            target_mask = targets != pad_idx
+            target_probs = probs.gather(2, targets[:, 1:max_steps].unsqueeze(2)).squeeze(2)
+            nll_sum = self.sos_nll(sos_output, targets, pad_idx)
+            nll_sum = nll_sum - (torch.log(target_probs + 10**-10) * target_mask[:, 1:max_steps]).sum()
+            return nll_sum / target_mask.sum(), sampled_idxs
+
+        decoder_outputs = torch.cat((sos_output.unsqueeze(1), torch.log(probs + 10**-10)), dim=1)
         return decoder_outputs, sampled_idxs
 
 
-    def step(self, prev_idx, prev_hidden, old, change, prev_selective_read, one_hot_input_seq_old, one_hot_input_seq_cha, pad):
+    def beam_search(self, old, change, inputs_old, inputs_cha, beam_size=4, length_penalty=1.0, vocab_ids=None):
+        # The beams of a sample are an extra batch dimension: row i*beam_size + j is beam j of sample i.
+        # A sample is done (and dropped from the batch) once beam_size hypotheses emitted [SEP].
+        # Returns the best sequence of every sample (b, max_steps, 1) in global ids and its score (b,).
 
-        # prev_hidden.shape = (b, 1, hidden)
-        # self.hidden_size = 768
-        assert old.shape[0] == change.shape[0]
-        assert old.shape[1] == change.shape[1]
         batch_size = old.shape[0]
-        # one_hot_input_seq.shape = (b, 2*seq_length, vocab_size)
-        one_hot_input_seq = torch.cat((one_hot_input_seq_old, one_hot_input_seq_cha), dim=1)
+        max_steps = self.decode_length(inputs_old, inputs_cha)
+        k = beam_size
+        n_vocab = self.vocab_size if vocab_ids is None else vocab_ids.shape[0]
+        cls_idx = int(self.to_vocab_index(vocab_ids, self.cls_to))
+        pad_idx = int(self.to_vocab_index(vocab_ids, self.pad_to))
+        sep_idx = int(self.to_vocab_index(vocab_ids, self.sep_to))
+
+        # the encoder outputs and the input ids are computed once and shared by all beams of a sample
+        # state.old.shape = (b*k, seq_length, hidden)
+        state = DecoderState(self, old, change, inputs_old, inputs_cha, vocab_ids)
+        state = state.select(torch.arange(batch_size, device=self.device).repeat_interleave(k))
+
+        hidden = torch.zeros(1, batch_size * k, self.hidden_size).to(self.device)
+        selective_read = torch.zeros(batch_size * k, 1, self.hidden_size).to(self.device)
+        pad = torch.ones(batch_size * k, dtype=torch.bool, device=self.device)
+        prev_idx = torch.full((batch_size * k, 1), cls_idx, dtype=torch.long, device=self.device)
+        # tokens.shape = (b*k, step)
+        tokens = prev_idx
+        # only the first beam of every sample is alive at the start
+        beam_scores = torch.zeros(batch_size, k, device=self.device)
+        beam_scores[:, 1:] = float('-inf')
+        beam_scores = beam_scores.view(-1)
+
+        # finished[i] = list of (normalized score, tokens) of sample i
+        finished = [[] for _ in range(batch_size)]
+        active = list(range(batch_size))
+        sep = torch.tensor([sep_idx], device=self.device)
+
+        for step_idx in range(1, max_steps):
+            n_active = len(active)
+
+            log_probs, hidden, copy_score_seq = self.score(prev_idx, hidden, state, selective_read, pad)
+            # cand_scores.shape = (n_active, k*n_vocab)
+            cand_scores = (beam_scores.unsqueeze(1) + log_probs).view(n_active, k * n_vocab)
+            # take 2k candidates so k of them are left after removing the [SEP] ones
+            top_scores, top_ids = cand_scores.topk(2 * k, dim=1)
+            beam_origin = torch.div(top_ids, n_vocab, rounding_mode='floor')
+            top_tokens = top_ids % n_vocab
+            is_sep = top_tokens == sep_idx
+
+            # [SEP] among the best k candidates finishes a hypothesis
+            sep_hits = is_sep[:, :k].nonzero()
+            if sep_hits.shape[0] > 0:
+                sep_scores = top_scores[sep_hits[:, 0], sep_hits[:, 1]] / (step_idx + 1) ** length_penalty
+                sep_rows = sep_hits[:, 0] * k + beam_origin[sep_hits[:, 0], sep_hits[:, 1]]
+                for i, score, row in zip(sep_hits[:, 0].tolist(), sep_scores.tolist(), sep_rows.tolist()):
+                    finished[active[i]].append((score, torch.cat((tokens[row], sep))))
+
+            # the best k candidates without [SEP] are the next beams
+            not_sep = ~is_sep
+            keep = not_sep & (torch.cumsum(not_sep, dim=1) <= k)
+            next_scores = top_scores[keep].view(n_active, k)
+            next_tokens = top_tokens[keep].view(n_active, k, 1)
+            # rows.shape = (n_active*k) -> the beam every new beam continues
+            rows = (beam_origin[keep].view(n_active, k) + k * torch.arange(n_active, device=self.device).unsqueeze(1)).view(-1)
+
+            prev_idx = next_tokens.view(-1, 1)
+            beam_scores = next_scores.view(-1)
+            hidden = hidden[:, rows]
+            tokens = torch.cat((tokens[rows], prev_idx), dim=1)
+            selective_read = self.get_selective_read(prev_idx, state, copy_score_seq[rows])
+
+            # prune the samples that have enough finished hypotheses
+            running = [len(finished[i]) < k for i in active]
+            if not all(running):
+                if not any(running):
+                    break
+                active = [i for i, r in zip(active, running) if r]
+                rows = torch.tensor(running, device=self.device).repeat_interleave(k)
+                state = state.select(rows)
+                hidden = hidden[:, rows]
+                selective_read = selective_read[rows]
+                pad = pad[rows]
+                prev_idx = prev_idx[rows]
+                tokens = tokens[rows]
+                beam_scores = beam_scores[rows]
+        else:
+            # max_steps reached, the alive beams count as finished
+            alive_scores = (beam_scores / tokens.shape[1] ** length_penalty).tolist()
+            for row, score in enumerate(alive_scores):
+                finished[active[row // k]].append((score, tokens[row]))
+
+        sampled_idxs = torch.full((batch_size, max_steps, 1), pad_idx, dtype=torch.long, device=self.device)
+        scores = torch.zeros(batch_size, device=self.device)
+        for i in range(batch_size):
+            score, seq = max(finished[i], key=lambda hyp: hyp[0])
+            sampled_idxs[i, :seq.shape[0], 0] = seq
+            scores[i] = score
+        if vocab_ids is not None:
+            # map back to the global token ids
+            sampled_idxs = vocab_ids[sampled_idxs]
+
+        return sampled_idxs, scores
+
+
+    def scripted_greedy(self, old, change, inputs_old, inputs_cha, vocab_ids=None):
+        # forward without targets through the TorchScript loop of GreedyDecoder (eval mode, no grad),
+        # same outputs as forward
+        assert not self.training
+
+        batch_size = old.shape[0]
+        max_steps = self.decode_length(inputs_old, inputs_cha)
+        cls_idx = int(self.to_vocab_index(vocab_ids, self.cls_to))
+        pad_idx = int(self.to_vocab_index(vocab_ids, self.pad_to))
+        sep_idx = int(self.to_vocab_index(vocab_ids, self.sep_to))
+        state = DecoderState(self, old, change, inputs_old, inputs_cha, vocab_ids)
+        table = self.embedding.projected_table()
+        table = table if vocab_ids is None else table[vocab_ids]
+
+        key = str(old.device)
+        if key not in self._scripted:
+            self._scripted[key] = torch.jit.script(GreedyDecoder(self))
+        decoder_outputs, sampled_idxs = self._scripted[key](state.memory, state.input_seq, state.missing_token_mask,
+                                                            state.pad_column, table, cls_idx, sep_idx, pad_idx, max_steps)
+        if vocab_ids is not None:
+            # map back to the global token ids
+            sampled_idxs = vocab_ids[sampled_idxs]
+
+        return decoder_outputs, sampled_idxs
+
+
+    def decode_length(self, inputs_old, inputs_cha, targets=None):
+        # number of decoding steps (with the [CLS]) of a batch: the longest target when it is given,
+        # else length_factor * the longest old or change, at most max_length
+        if targets is not None:
+            length = int((targets != self.pad_to).sum(dim=1).max())
+        elif self.length_factor is None:
+            return self.max_length
+        else:
+            longest = max(int((inputs_old != self.pad_to).sum(dim=1).max()),
+                          int((inputs_cha != self.pad_to).sum(dim=1).max()))
+            length = math.ceil(self.length_factor * longest)
+        return max(1, min(length, self.max_length))
+
+
+    def step(self, prev_idx, prev_hidden, state, prev_selective_read, pad, return_probs=False):
+        # prev_idx is an index into state.vocab_ids if it is given
+        # return_probs: return the probs instead of the log_probs (same argmax)
+        batch_size = prev_idx.shape[0]
+
+        log_probs, hidden, copy_score_seq = self.score(prev_idx, prev_hidden, state, prev_selective_read, pad,
+                                                       return_probs=return_probs)
+        # topi = (b, 1) -> argmax von log_probs
+        _, topi = log_probs.topk(1)
+        # sampled_idx = (b, 1) -> idx aus n_vocab
+        sampled_idx = topi.view(batch_size, 1)
+
+        selective_read = self.get_selective_read(sampled_idx, state, copy_score_seq)
+
+        return sampled_idx, log_probs, hidden, selective_read
+
+
+    def score(self, prev_idx, prev_hidden, state, prev_selective_read, pad, return_probs=False):
+        # one GRU step, returns the log_probs over the (restricted) vocab, the new hidden state
+        # and the copy scores of every input position
+        # state: DecoderState of the batch, pad: mask the [PAD] column (b,)
+        # return_probs: skip the log, the probs are returned instead of the log_probs
+
+        # prev_hidden.shape = (b, 1, hidden)
+        batch_size, seq_length, _ = state.old.shape
+        # memory.shape = (b, 2, seq_length, hidden) -> [old, change]
+        memory = state.memory.view(batch_size, 2, seq_length, self.hidden_size)
 
         # ATTENTION mechanism for LAW & CHANGE
         # transformed_hidden.shape = (b, hidden, 1)
         transformed_hidden = self.attn_W(prev_hidden).view(batch_size, self.hidden_size, 1)
         # reduce encoder outputs and hidden to get scores
-        # apply softmax to scores to get normalized weights
-        # attn_.shape = (3, seq_length, 1)
-        attn_scores_old = torch.bmm(old, transformed_hidden)
-        attn_weights_old = F.softmax(attn_scores_old, dim=1)
-        attn_scores_cha = torch.bmm(change, transformed_hidden)
-        attn_weights_cha = F.softmax(attn_scores_cha, dim=1)
+        # apply softmax to scores to get normalized weights (separately for old and change)
+        # attn_weights.shape = (b, 2, 1, seq_length)
+        attn_scores = torch.bmm(state.memory, transformed_hidden).view(batch_size, 2, 1, seq_length)
+        attn_weights = F.softmax(attn_scores, dim=3)
 
         # weighted sum of encoder_outputs (i.e. values)
-        # context_.shape = (b, 1, hidden)
-        context_old = torch.bmm(torch.transpose(attn_weights_old, 1, 2), old)
-        context_cha = torch.bmm(torch.transpose(attn_weights_cha, 1, 2), change)
+        # context.shape = (b, 1, 2*hidden) -> [context_old, context_cha]
+        context = torch.matmul(attn_weights, memory).view(batch_size, 1, 2 * self.hidden_size)
         # Embedded the prev token
-        embedded = self.embedding(prev_idx)
+        embedded = self.embedding(prev_idx if state.vocab_ids is None else state.vocab_ids[prev_idx])
 
         # GRU STEP
         # gru_input.shape = (b, 1, 4*hidden)
-        gru_input = torch.cat((context_old, context_cha, prev_selective_read, embedded), dim=2)
-        self.gru.flatten_parameters()
+        gru_input = torch.cat((context, prev_selective_read, embedded), dim=2)
+        if hasattr(self.gru, 'flatten_parameters'):
+            # not there after the dynamic int8 quantization
+            self.gru.flatten_parameters()
         # output.shape = (b, 1, hidden)
         # hidden.shape = (1, b, hidden)
         output, hidden = self.gru(gru_input, prev_hidden)
 
         # COPY mechanism for LAW & CHANGE
-        # transformed_hidden_old.shape = (b, hidden, 1)
+        # transformed_hidden.shape = (b, hidden, 1)
         transformed_hidden = self.copy_W(output).view(batch_size, self.hidden_size, 1)
-        # copy_score_seq.shape = (b, seq_length, 1)
-        copy_score_seq_old = torch.bmm(old, transformed_hidden)
-        copy_score_seq_cha = torch.bmm(change, transformed_hidden)
         # copy_score_seq.shape = (b, 2*seq_length, 1)
-        copy_score_seq = torch.cat((copy_score_seq_old, copy_score_seq_cha), dim = 1)
-        # copy_scores.shape = (b, vocab_size)
-        copy_scores_old = torch.bmm(torch.transpose(copy_score_seq_old, 1, 2), one_hot_input_seq_old).squeeze(1)
-        copy_scores_cha = torch.bmm(torch.transpose(copy_score_seq_cha, 1, 2), one_hot_input_seq_cha).squeeze(1)
+        copy_score_seq = torch.bmm(state.memory, transformed_hidden)
+        # scatter the position scores of old and change onto their token ids (same as a bmm against the one-hot inputs)
+        # combined_scores.shape = (b, n_vocab)
+        # always in fp32: under autocast (bf16/fp16 training) the -2000000.0 does not fit into fp16 and the
+        # [PAD] + 10**-10 of the log vanish in bf16, the scores of repeated tokens are summed up exactly
+        combined_scores = copy_score_seq.new_zeros((batch_size, state.n_vocab), dtype=torch.float)
+        combined_scores = combined_scores.scatter_add(1, state.input_seq, copy_score_seq.squeeze(2).float())
         # penalize tokens that are not present in the old or chaged laws (+ MASK, CLS and PAD Token)
-        # missing_token_mask.shape = (b, vocab_size)
-        missing_token_mask_old = (one_hot_input_seq_old.sum(dim=1) == 0)
-        missing_token_mask_old[:, self.mask_to] = True
-        missing_token_mask_old[:, self.pad_to] = pad
-        missing_token_mask_cha = (one_hot_input_seq_cha.sum(dim=1) == 0)
-        missing_token_mask_cha[:, self.mask_to] = True
-        missing_token_mask_cha[:, self.pad_to] = pad
-        missing_token_mask = torch.logical_and(missing_token_mask_old, missing_token_mask_cha)
-        # copy_scores.shape = (b, vocab_size)
-        copy_scores_old = copy_scores_old.masked_fill(missing_token_mask, -1000000.0)
-        copy_scores_cha = copy_scores_cha.masked_fill(missing_token_mask, -1000000.0)
-
-        # Combine results LAW & Change
-        # combined_scores.shape = (b, vocab_size)
-        combined_scores = copy_scores_old + copy_scores_cha
-        # probs.shape = (b, vocab_size)
+        # missing_token_mask.shape = (b, n_vocab)
+        missing_token_mask = state.missing_token_mask | (state.pad_column & pad.unsqueeze(1))
+        # -1000000.0 for old and for change
+        combined_scores = combined_scores.masked_fill(missing_token_mask, -2000000.0)
+
+        # probs.shape = (b, n_vocab)
         probs = F.softmax(combined_scores, dim=1)
+        if return_probs:
+            return probs, hidden, copy_score_seq
 
         # log_probs = (b, log_probs)
         log_probs = torch.log(probs + 10**-10)
-        # topi = (b, 1) -> argmax von log_probs
-        _, topi = log_probs.topk(1)
-        # sampled_idx = (b, 1) -> idx aus vocab_size
-        sampled_idx = topi.view(batch_size, 1)
 
+        return log_probs, hidden, copy_score_seq
+
+
+    def get_selective_read(self, sampled_idx, state, copy_score_seq):
         # Create selective read embedding for next time step
-        # reshaped_idxs.shape = (b, 2*seq_length, 1)
-        reshaped_idxs = sampled_idx.view(-1, 1, 1).expand(one_hot_input_seq.shape[0], one_hot_input_seq.shape[1], 1)
-        pos_in_input_of_sampled_token = one_hot_input_seq.gather(2, reshaped_idxs)
+        # pos_in_input_of_sampled_token.shape = (b, 2*seq_length, 1)
+        pos_in_input_of_sampled_token = (state.input_seq == sampled_idx).unsqueeze(2).to(copy_score_seq.dtype)
         # selected_scores.shape = (b, 2*seq_length, 1)
         selected_scores = pos_in_input_of_sampled_token * copy_score_seq
         # selected_scores_norm.shape = (b, 2*seq_length, 1)
         selected_scores_norm = F.normalize(selected_scores, p=1)
-        # selected_scores_norm.shape = (b, 2*seq_length, hidden)
-        encoder_outputs = torch.cat((old, change),dim=1)
-        # selective_read.shape = (b, 1, hiddem)
-        selective_read = (selected_scores_norm * encoder_outputs).sum(dim=1).unsqueeze(1)
+        # selective_read.shape = (b, 1, hidden)
+        selective_read = torch.bmm(selected_scores_norm.transpose(1, 2), state.memory)
+
+        return selective_read
 
-        return sampled_idx, log_probs, hidden, selective_read
 
+    def batch_vocab(self, inputs_old, inputs_cha, targets=None):
+        """ Sorted union of the token ids of a batch (+ the special tokens), the only tokens the decoder can emit. """
+        special = torch.tensor([self.pad_to, self.cls_to, self.sep_to, self.mask_to], device=inputs_old.device)
+        ids = [inputs_old.flatten(), inputs_cha.flatten(), special]
+        if targets is not None:
+            ids.append(targets.flatten())
+        return torch.unique(torch.cat(ids).long())
 
-    def to_one_hot(self, y, n_dims=None):
-        """ Take integer y (tensor or variable) with n dims and convert it to 1-hot representation with n+1 dims. """
-        y_tensor = y.long().contiguous().view(-1, 1)
-        n_dims = n_dims if n_dims is not None else int(torch.max(y_tensor)) + 1
-        y_one_hot = torch.zeros(y_tensor.shape[0], n_dims).to(self.device).scatter_(1, y_tensor, 1)
-        y_one_hot = y_one_hot.view(*y.shape, -1)
-        return y_one_hot
 
+    @staticmethod
+    def to_vocab_index(vocab_ids, ids):
+        """ Map global token ids onto their position in vocab_ids (no-op for the full vocab). """
+        if vocab_ids is None:
+            return ids
+        return torch.searchsorted(vocab_ids, ids)
@@ -1,16 +1,203 @@
 #Imports
+import os
+import json
+import math
+import hashlib
+from functools import lru_cache
+from collections import OrderedDict
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from transformers import AutoConfig, AutoTokenizer
 
 
 class Encoder(nn.Module):
-    def __init__(self, model_loaded):
+    def __init__(self, model_loaded, cache=None, overlap=128):
         super(Encoder, self).__init__()
         self.BERT = model_loaded.model.bert
+        # inputs longer than the BERT positions (512) are encoded as overlapping windows (see windowed)
+        self.window = self.BERT.config.max_position_embeddings
+        self.overlap = overlap
+        assert 0 <= overlap < self.window
+        # optional EncoderCache, only used when no gradient through the encoder is needed
+        self.cache = cache
+        # set by EncoderDecoder.set_precision, part of the cache key
+        self.precision = 'fp32'
+        self._version_state = None
+        self._version = None
 
     def forward(self, input_ids, attention_mask):
         # iput batch musst at least have: 'input_ids' && 'attention_mask'
-        outputs = self.BERT(input_ids, attention_mask=attention_mask)
-        outputs = outputs['last_hidden_state']
-        return outputs
+        if self.use_cache():
+            return self.cached_forward(input_ids, attention_mask)
+        return self.windowed(input_ids, attention_mask)
 
+    def windowed(self, input_ids, attention_mask):
+        # input_ids.shape = (b, seq) with any seq, outputs.shape = (b, seq, 768)
+        batch_size, seq_length = input_ids.shape
+        if seq_length <= self.window:
+            return self.BERT(input_ids, attention_mask=attention_mask)['last_hidden_state']
+
+        # n_windows windows of self.window tokens, each starting stride after the last one (all in one BERT call)
+        stride = self.window - self.overlap
+        n_windows = 1 + math.ceil((seq_length - self.window) / stride)
+        padded = self.window + (n_windows - 1) * stride - seq_length
+        # windows.shape = (b*n_windows, window)
+        input_windows = F.pad(input_ids, (0, padded)).unfold(1, self.window, stride).reshape(-1, self.window)
+        mask_windows = F.pad(attention_mask, (0, padded)).unfold(1, self.window, stride).reshape(-1, self.window)
+        outputs = self.BERT(input_windows, attention_mask=mask_windows)['last_hidden_state']
+        # outputs.shape = (b, n_windows*window, 768)
+        outputs = outputs.reshape(batch_size, n_windows * self.window, -1)
+
+        # stitch: every position is taken from the window where it has the most context,
+        # window k covers [k*stride + overlap//2, (k+1)*stride + overlap//2) (the first from 0, the last up to seq)
+        positions = torch.arange(seq_length, device=input_ids.device)
+        k = torch.div(positions - self.overlap // 2, stride, rounding_mode='floor').clamp(0, n_windows - 1)
+        index = k * self.window + positions - k * stride
+        return outputs[:, index]
+
+    def use_cache(self):
+        if self.cache is None or self.BERT.training:
+            return False
+        return not (torch.is_grad_enabled() and any(p.requires_grad for p in self.BERT.parameters()))
+
+    def cached_forward(self, input_ids, attention_mask):
+        version = self.weights_version()
+        if self.precision != 'fp32':
+            version = version + '-' + self.precision
+        if input_ids.shape[1] > self.window:
+            version = version + f'-overlap{self.overlap}'
+        keys = [self.cache.key(input_ids[i], attention_mask[i], version) for i in range(input_ids.shape[0])]
+        rows = [self.cache.get(key) for key in keys]
+
+        # encode the misses in one batch
+        missing = [i for i, row in enumerate(rows) if row is None]
+        if missing:
+            outputs = self.windowed(input_ids[missing], attention_mask[missing])
+            for j, i in enumerate(missing):
+                rows[i] = outputs[j]
+                self.cache.put(keys[i], outputs[j].float().cpu().numpy())
+
+        outputs = [row.float() if torch.is_tensor(row) else torch.from_numpy(np.array(row)).to(input_ids.device) for row in rows]
+        return torch.stack(outputs)
+
+    def weights_version(self):
+        # hash of the encoder weights, recomputed when a parameter was changed in place
+        # (optimizer step, load_state_dict) or replaced
+        state = tuple((p.data_ptr(), p._version) for p in self.BERT.parameters())
+        if state != self._version_state:
+            h = hashlib.sha1()
+            for p in self.BERT.parameters():
+                h.update(p.detach().cpu().numpy().tobytes())
+            self._version = h.hexdigest()
+            self._version_state = state
+        return self._version
+
+
+class EncoderCache:
+    # Last hidden states on disk, one .npy per input (loaded memory-mapped),
+    # keyed by a hash of (input_ids, attention_mask, encoder weights version).
+    # The least recently used entries are removed when there are more than max_entries.
+    def __init__(self, path, max_entries=20000):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        files = [f for f in os.listdir(path) if f.endswith('.npy')]
+        files.sort(key=lambda f: os.path.getmtime(os.path.join(path, f)))
+        # key -> None, ordered from least to most recently used
+        self.entries = OrderedDict((f[:-4], None) for f in files)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, input_ids, attention_mask, version):
+        h = hashlib.sha1(version.encode())
+        h.update(input_ids.detach().cpu().numpy().astype(np.int64).tobytes())
+        h.update(attention_mask.detach().cpu().numpy().astype(np.int64).tobytes())
+        return h.hexdigest()
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        fname = os.path.join(self.path, key + '.npy')
+        try:
+            # the mtime keeps the LRU order for the next process
+            os.utime(fname)
+            row = np.load(fname, mmap_mode='r')
+        except FileNotFoundError:
+            # evicted by another process
+            del self.entries[key]
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return row
+
+    def put(self, key, value):
+        # write to a temporary file first so other processes never see half written entries
+        tmp = os.path.join(self.path, f'{key}.{os.getpid()}.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, value)
+        os.replace(tmp, os.path.join(self.path, key + '.npy'))
+        self.entries[key] = None
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            old_key, _ = self.entries.popitem(last=False)
+            try:
+                os.remove(os.path.join(self.path, old_key + '.npy'))
+            except FileNotFoundError:
+                pass
+
+
+# vocab size and the ids of the special tokens of a tokenizer (loaded once per process)
+@lru_cache(maxsize=None)
+def special_token_ids(checkpoint):
+    tokenizer = AutoTokenizer.from_pretrained(checkpoint)
+    ids = {'vocab_size': tokenizer.vocab_size}
+    for name in ['pad', 'cls', 'sep', 'mask']:
+        ids[name] = tokenizer(f'[{name.upper()}]', add_special_tokens=False)['input_ids'][0]
+    return ids
+
+
+# torch.load memory-mapped where the torch version supports it
+def load_checkpoint(path, device):
+    try:
+        return torch.load(path, map_location=device, mmap=True)
+    except (TypeError, RuntimeError):
+        return torch.load(path, map_location=device)
+
+
+# Write the encoder part of a MLM checkpoint (train_loop_ddp.py) with everything EncoderDecoder needs:
+# the BERT weights without the MLM head, the BERT config and the special token ids.
+# *.safetensors: weights in safetensors (memory-mapped when loaded), the rest as metadata, else torch.save
+def save_encoder_checkpoint(model_path, out_path):
+
+    BERTload = torch.load(model_path, map_location='cpu')
+    prefix = 'model.bert.'
+    bert_state_dict = {key[len(prefix):]: value.contiguous() for key, value in BERTload['model_state_dict'].items()
+                       if key.startswith(prefix)}
+    slim = {'checkpoint': BERTload['checkpoint'],
+            'config': AutoConfig.from_pretrained(BERTload['checkpoint']).to_dict(),
+            'special_ids': special_token_ids(BERTload['checkpoint'])}
+
+    if out_path.endswith('.safetensors'):
+        from safetensors.torch import save_file
+        save_file(bert_state_dict, out_path, metadata={key: json.dumps(value) for key, value in slim.items()})
+    else:
+        slim['bert_state_dict'] = bert_state_dict
+        torch.save(slim, out_path)
+
+
+# Counterpart of save_encoder_checkpoint -> dict with checkpoint, config, special_ids, bert_state_dict
+def load_encoder_checkpoint(path, device):
+
+    if not path.endswith('.safetensors'):
+        return load_checkpoint(path, device)
+
+    from safetensors import safe_open
+    from safetensors.torch import load_file
+    with safe_open(path, framework='pt') as f:
+        slim = {key: json.loads(value) for key, value in f.metadata().items()}
+    slim['bert_state_dict'] = load_file(path, device=str(device))
+    return slim
@@ -1,57 +1,184 @@
 # Imports
+from contextlib import nullcontext
 from torch import nn
 import torch
+import torch.nn.functional as F
 from decoder import Decoder
-from encoder import Encoder
+from span_decoder import SpanDecoder
+from encoder import Encoder, load_checkpoint, load_encoder_checkpoint, special_token_ids
 from lawsCOPY import LawNetMLM
-from transformers import AutoTokenizer
+from transformers import AutoConfig, BertConfig
 
 
 class EncoderDecoder(nn.Module):
 
-    def __init__(self, model_path, device, hidden_size=200, max_length=512):
+    def __init__(self, model_path, device, hidden_size=200, max_length=512, span=False, trim_padding=False,
+                 encoder_cache=None, length_factor=2.0, window_overlap=128, parallel_teacher_forcing=False):
         super(EncoderDecoder, self).__init__()
 
         self.device = device
         self.hidden_size = hidden_size
         self.bert_output_size = 768
+        # cut the columns that are [PAD] in every old and change of a batch before the encoder
+        # (the decoder attends over the [PAD] positions as well, so this changes the scores slightly)
+        self.trim_padding = trim_padding
         
         # Encoder
-        BERTload = torch.load(model_path, map_location=device)
-        model_loaded = LawNetMLM(BERTload['checkpoint'])
-        model_loaded.load_state_dict(BERTload['model_state_dict'])
-        self.encoder = Encoder(model_loaded).to(self.device)
+        # model_path: MLM checkpoint (train_loop_ddp.py) or slim encoder checkpoint (slim_checkpoint.py),
+        # the architecture is built from the config, the weights only come from the checkpoint
+        if model_path.endswith('.safetensors'):
+            BERTload = load_encoder_checkpoint(model_path, device)
+        else:
+            BERTload = load_checkpoint(model_path, device)
+        if 'bert_state_dict' in BERTload:
+            model_loaded = LawNetMLM(BERTload['checkpoint'], config=BertConfig.from_dict(BERTload['config']))
+            model_loaded.model.bert.load_state_dict(BERTload['bert_state_dict'])
+            special_ids = BERTload['special_ids']
+        else:
+            model_loaded = LawNetMLM(BERTload['checkpoint'], config=AutoConfig.from_pretrained(BERTload['checkpoint']))
+            model_loaded.load_state_dict(BERTload['model_state_dict'])
+            special_ids = special_token_ids(BERTload['checkpoint'])
+        # encoder_cache: optional EncoderCache that reuses the encoder outputs of identical inputs
+        # old/change longer than 512 tokens are encoded in windows that overlap by window_overlap tokens,
+        # the decoder attends over and copies from the whole stitched sequence
+        self.encoder = Encoder(model_loaded, cache=encoder_cache, overlap=window_overlap).to(self.device)
 
         # Link
         self.ff_old = nn.Linear(self.bert_output_size, self.hidden_size).to(self.device)
         self.ff_cha = nn.Linear(self.bert_output_size, self.hidden_size).to(self.device)
 
         # Settings
-        tokenizer = AutoTokenizer.from_pretrained(BERTload['checkpoint'])
-        self.vocab_size = tokenizer.vocab_size
-        pad_to = tokenizer('[PAD]', add_special_tokens=False)['input_ids'][0]
-        cls_to = tokenizer('[CLS]', add_special_tokens=False)['input_ids'][0]
-        sep_to = tokenizer('[SEP]', add_special_tokens=False)['input_ids'][0]
-        mask_to = tokenizer('[MASK]', add_special_tokens=False)['input_ids'][0]
-
-        # Decoder
-        self.decoder = Decoder(self.hidden_size, max_length, self.vocab_size, self.device,
-                               model_loaded, pad_to, cls_to, sep_to, mask_to).to(self.device)
-
-    def forward(self, old, change, targets=None, teacher_forcing=1.0):
-
-        # encoder_outputs.shape(b,seq,768)
-        encoder_outputs_old = self.encoder(**old)
-        encoder_outputs_change = self.encoder(**change)
-        # outputs.shape = (b, seq, hidden)
-        outputs_old = self.ff_old(encoder_outputs_old)
-        outputs_cha = self.ff_cha(encoder_outputs_change)
+        self.vocab_size = special_ids['vocab_size']
+        pad_to = special_ids['pad']
+        cls_to = special_ids['cls']
+        sep_to = special_ids['sep']
+        mask_to = special_ids['mask']
+
+        # Decoder (span: copies whole spans of old/change, targets are then the span actions)
+        # without targets it decodes length_factor * the longest input of a batch (None -> max_length steps)
+        decoder_class = SpanDecoder if span else Decoder
+        self.decoder = decoder_class(self.hidden_size, max_length, self.vocab_size, self.device,
+                                     model_loaded, pad_to, cls_to, sep_to, mask_to,
+                                     length_factor=length_factor).to(self.device)
+        # teacher_forcing=1.0: all steps in one pass with an approximated recurrence (Decoder.teacher_forced)
+        self.decoder.parallel_teacher_forcing = parallel_teacher_forcing and not span
+
+        # inference precision of the encoder (see set_precision)
+        self.precision = 'fp32'
+
+    def enable_checkpointing(self, every=8):
+        # Training: recompute the activations in the backward pass instead of keeping them,
+        # the BERT layers and segments of every decoder steps (see Decoder.forward_targets)
+        self.encoder.BERT.gradient_checkpointing_enable()
+        self.decoder.checkpoint_every = every
+
+    def set_precision(self, precision):
+        # Inference only, call it after load_state_dict:
+        # 'int8': dynamic int8 quantization (CPU), see quantize
+        # 'bf16'/'fp16': the encoder and ff_old/ff_cha run under autocast, the decoder stays in fp32
+        # (the -1000000.0 of its masking does not fit into fp16)
+        assert precision in ['fp32', 'bf16', 'fp16', 'int8']
+        assert self.precision == 'fp32', 'the precision can only be set once'
+        if precision == 'int8':
+            self.quantize()
+        self.precision = precision
+        self.encoder.precision = precision
+
+    def quantize(self):
+        # dynamic int8 quantization: the weights of the Linear layers of BERT, of ff_old/ff_cha and of the GRU
+        # are stored in int8, the activations are quantized on the fly (CPU only, no training afterwards).
+        # The embeddings stay in fp32, they are shared with the decoder.
+        assert torch.device(self.device).type == 'cpu'
+        qconfig = torch.quantization.default_dynamic_qconfig
+        torch.quantization.quantize_dynamic(self, {'encoder.BERT.encoder': qconfig,
+                                                   'ff_old': qconfig,
+                                                   'ff_cha': qconfig,
+                                                   'decoder.gru': qconfig}, inplace=True)
+        # the scripted greedy loops still hold the fp32 GRU
+        self.decoder._scripted = {}
+
+    def autocast(self):
+        # fp32: no context at all, so the autocast of a bf16/fp16 training loop (train_COPY.py --amp) stays on
+        if self.precision not in ['bf16', 'fp16']:
+            return nullcontext()
+        dtype = torch.bfloat16 if self.precision == 'bf16' else torch.float16
+        return torch.autocast(torch.device(self.device).type, dtype=dtype)
+
+    def encode(self, old, change):
+
+        # precomputed encoder outputs (frozen encoder, see precompute_COPY.py)
+        if 'projected' in old:
+            return old['projected'].float(), change['projected'].float(), old['input_ids'], change['input_ids']
+        if 'features' in old:
+            outputs_old = self.ff_old(old['features'].float())
+            outputs_cha = self.ff_cha(change['features'].float())
+            return outputs_old, outputs_cha, old['input_ids'], change['input_ids']
+
+        batch_size = old['input_ids'].shape[0]
+        seq_length = max(old['input_ids'].shape[1], change['input_ids'].shape[1])
+        # old and change in one batch (2b, seq) -> one BERT call instead of two
+        input_ids = torch.cat((F.pad(old['input_ids'], (0, seq_length - old['input_ids'].shape[1])),
+                               F.pad(change['input_ids'], (0, seq_length - change['input_ids'].shape[1]))), dim=0)
+        attention_mask = torch.cat((F.pad(old['attention_mask'], (0, seq_length - old['attention_mask'].shape[1])),
+                                    F.pad(change['attention_mask'], (0, seq_length - change['attention_mask'].shape[1]))), dim=0)
+        if self.trim_padding:
+            seq_length = int(attention_mask.sum(dim=1).max())
+            input_ids = input_ids[:, :seq_length]
+            attention_mask = attention_mask[:, :seq_length]
+
+        with self.autocast():
+            # encoder_outputs.shape(2b,seq,768)
+            encoder_outputs = self.encoder(input_ids, attention_mask)
+            # outputs.shape = (b, seq, hidden)
+            outputs_old = self.ff_old(encoder_outputs[:batch_size])
+            outputs_cha = self.ff_cha(encoder_outputs[batch_size:])
+
+        # the decoder runs in fp32
+        return outputs_old.float(), outputs_cha.float(), input_ids[:batch_size], input_ids[batch_size:]
+
+    def forward(self, old, change, targets=None, teacher_forcing=1.0, vocab_ids=None, return_log_probs=True):
+        # return_log_probs=False: with targets the decoder returns the (streamed) NLL instead of the log_probs
+
+        outputs_old, outputs_cha, inputs_old, inputs_cha = self.encode(old, change)
 
         decoder_outputs, sampled_idxs = self.decoder(outputs_old,
                                                      outputs_cha,
-                                                     old['input_ids'],
-                                                     change['input_ids'],
+                                                     inputs_old,
+                                                     inputs_cha,
                                                      targets=targets,
-                                                     teacher_forcing=teacher_forcing)
+                                                     teacher_forcing=teacher_forcing,
+                                                     vocab_ids=vocab_ids,
+                                                     return_log_probs=return_log_probs)
+
+        return decoder_outputs, sampled_idxs
+
+    @torch.no_grad()
+    def generate(self, old, change, beam_size=4, length_penalty=1.0, vocab_ids=None):
+
+        # the encoder runs once, the beams only live in the decoder
+        outputs_old, outputs_cha, inputs_old, inputs_cha = self.encode(old, change)
+
+        # sampled_idxs.shape = (b, max_steps, 1), scores.shape = (b,)
+        sampled_idxs, scores = self.decoder.beam_search(outputs_old,
+                                                        outputs_cha,
+                                                        inputs_old,
+                                                        inputs_cha,
+                                                        beam_size=beam_size,
+                                                        length_penalty=length_penalty,
+                                                        vocab_ids=vocab_ids)
+
+        return sampled_idxs, scores
+
+    @torch.no_grad()
+    def scripted_greedy(self, old, change, vocab_ids=None):
+
+        # forward without targets, the decoder loop runs as TorchScript (call eval() first)
+        outputs_old, outputs_cha, inputs_old, inputs_cha = self.encode(old, change)
+
+        decoder_outputs, sampled_idxs = self.decoder.scripted_greedy(outputs_old,
+                                                                     outputs_cha,
+                                                                     inputs_old,
+                                                                     inputs_cha,
+                                                                     vocab_ids=vocab_ids)
 
         return decoder_outputs, sampled_idxs
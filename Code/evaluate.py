@@ -1,43 +1,54 @@
 #Impots 
 import torch
+import torch.nn.functional as F
 import numpy as np
 from encoder_decoder import EncoderDecoder
+from lawsCOPY import batch_span_actions, batch_to_device
 from sklearn.metrics import accuracy_score
 from tqdm import tqdm
 
 
 # Evaluate Model
-def evaluate(encoder_decoder: EncoderDecoder, val_loader):
+def evaluate(encoder_decoder: EncoderDecoder, val_loader, restrict_vocab=False, span=False, min_span=4):
     
-    loss_function = torch.nn.NLLLoss(ignore_index=0) 
     # goes through the test dataset and computes the test accuracy
     val_loss_cum = 0.0
     val_acc = 0.0
 
     # bring the models into eval mode
     encoder_decoder.eval()
+    decoder = getattr(encoder_decoder, 'module', encoder_decoder).decoder
+    device = next(encoder_decoder.parameters()).device
     
     with torch.no_grad():
 
         num_eval_samples = 0
 
         pbar = tqdm(val_loader, desc='Validation')
-        for input_,change_,target_ in pbar:
+        for batch in pbar:
 
-            batch_size = batch_size = input_['input_ids'].shape[0]
+            input_,change_,target_ = batch_to_device(batch, device)
+            batch_size = input_['input_ids'].shape[0]
+            tar_length = target_.shape[1]
 
-            # output_log_probs.shape = (b, max_length, voc_size)
-            # output_seqs.shape: (b, max_length, 1)
-            output_log_probs, output_seqs = encoder_decoder(input_,change_,target_) 
-
-            # Get the loss and the prediction
-            flattened_log_probs = output_log_probs.view(batch_size * 512, -1)
-
-            loss = loss_function(flattened_log_probs, target_.contiguous().view(-1))
+            # output_seqs.shape: (b, steps, 1), steps = longest target of the batch
+            vocab_ids = None
+            if restrict_vocab:
+                vocab_ids = decoder.batch_vocab(input_['input_ids'], change_['input_ids'], target_)
+            if span:
+                # loss over the span actions, accuracy of the greedy decoded sequence
+                actions = batch_span_actions(input_['input_ids'], change_['input_ids'], target_, min_span)
+                loss, _ = encoder_decoder(input_,change_,actions,vocab_ids=vocab_ids)
+                _, output_seqs = encoder_decoder(input_,change_,vocab_ids=vocab_ids)
+            else:
+                # Get the loss (NLL of the targets, summed up step by step) and the prediction
+                loss, output_seqs = encoder_decoder(input_,change_,target_,vocab_ids=vocab_ids,return_log_probs=False)
 
             # Get the prdictet and true tokens words for the Masked Tokens
             y_true = target_.to('cpu')
-            y_pred = output_seqs.squeeze(-1).to('cpu')
+            # the greedy output can be shorter or longer than the targets -> compare tar_length positions
+            y_pred = output_seqs.squeeze(-1)[:, :tar_length].to('cpu')
+            y_pred = F.pad(y_pred, (0, tar_length - y_pred.shape[1]), value=decoder.pad_to)
 
             # Calutate the Accuracy
             acc = accuracy_score(torch.flatten(y_true), 
@@ -1,15 +1,22 @@
+import os
+import json
 import torch.nn as nn
 import torch
 import numpy as np
+from difflib import SequenceMatcher
 from transformers import BertForMaskedLM
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 
 
 class LawNetMLM(nn.Module):
 
-    def __init__(self, checkpoint):
+    def __init__(self, checkpoint, config=None):
         super(LawNetMLM, self).__init__()
-        self.model = BertForMaskedLM.from_pretrained(checkpoint)
+        # config: only build the architecture (no pretrained weights), when a state_dict is loaded anyway
+        if config is None:
+            self.model = BertForMaskedLM.from_pretrained(checkpoint)
+        else:
+            self.model = BertForMaskedLM(config)
 
     def forward(self, input_ids=None, attention_mask=None, labels=None):
         #Extract outputs from the body
@@ -19,37 +26,173 @@ class LawNetMLM(nn.Module):
         return outputs
 
 
-# Data set for the Copy-Task
+# Data set for the Copy-Task, the items are compact CPU arrays without the padding
+# (the padding, the masks and the move to the device are done per batch, see collate_for_COPY)
 class DatasetForCOPY(Dataset):
 
-    def __init__(self, data, device):
+    def __init__(self, data):
         self.len = len(data)
         self.data = data
-        self.device = device
 
     def __len__(self):
         return self.len
 
     def __getitem__(self, idx):
-        
-        in_ = self.data[idx][0]
-        in_at = np.array(in_, dtype=bool).astype('int')
-        cha_ = self.data[idx][1]
-        cha_at = np.array(cha_, dtype=bool).astype('int')
-        tar_ = self.data[idx][2]
-
-        input_ = {'input_ids':torch.from_numpy(in_).long().to(self.device),
-                  'attention_mask': torch.from_numpy(in_at).long().to(self.device)}
-        change_ = {'input_ids': torch.from_numpy(cha_).long().to(self.device),
-                   'attention_mask': torch.from_numpy(cha_at).long().to(self.device)}
-        target_ = torch.from_numpy(tar_).long().to(self.device)
+
+        if isinstance(self.data, PackedCopyPairs):
+            in_, cha_, tar_ = self.data.unpadded(idx)
+        else:
+            in_, cha_, tar_ = (strip_padding(row) for row in self.data[idx])
+
+        return ({'input_ids': in_}, {'input_ids': cha_}, tar_)
+
+
+# Data set for the Copy-Task with precomputed encoder outputs (see precompute_COPY.py),
+# input_ and change_ get the key 'features' (BERT outputs) or 'projected' (after ff_old/ff_cha)
+class DatasetForCOPYFeatures(DatasetForCOPY):
+
+    def __init__(self, data, path, kind):
+        super(DatasetForCOPYFeatures, self).__init__(data)
+        self.shards, meta = load_features(path, kind)
+        assert meta['num'] == self.len
+        self.shard_size = meta['shard_size']
+        self.key = 'projected' if meta['projected'] else 'features'
+
+    def __getitem__(self, idx):
+
+        input_, change_, target_ = super(DatasetForCOPYFeatures, self).__getitem__(idx)
+        # features.shape = (2, seq_length, dim) float16
+        features = self.shards[idx // self.shard_size][idx % self.shard_size]
+        input_[self.key] = np.array(features[0, :input_['input_ids'].shape[0]])
+        change_[self.key] = np.array(features[1, :change_['input_ids'].shape[0]])
 
         return (input_, change_, target_)
 
 
+# Cut the [PAD] tokens at the end of a law
+def strip_padding(row, pad_to=0):
+    nonpad = np.flatnonzero(row != pad_to)
+    length = nonpad[-1] + 1 if nonpad.shape[0] > 0 else 0
+    return row[:length]
+
+
+# Batch the items of DatasetForCOPY: old and change are padded to the longest of both
+# (the decoder needs them with the same length), new to the longest new of the batch.
+# Returns CPU tensors, move them with batch_to_device (pin_memory=True in the DataLoader)
+def collate_for_COPY(batch, pad_to=0):
+
+    inputs, changes, targets = zip(*batch)
+    seq_length = max(x['input_ids'].shape[0] for x in inputs + changes)
+    tar_length = max(x.shape[0] for x in targets)
+
+    def pad(rows, length, fill):
+        rows = [np.asarray(row) for row in rows]
+        dtype = np.int64 if rows[0].dtype.kind in 'iu' else rows[0].dtype
+        padded = np.full((len(rows), length) + rows[0].shape[1:], fill, dtype=dtype)
+        for i, row in enumerate(rows):
+            padded[i, :row.shape[0]] = row
+        return torch.from_numpy(padded)
+
+    def stack(items):
+        out = {key: pad([x[key] for x in items], seq_length, pad_to if key == 'input_ids' else 0)
+               for key in items[0]}
+        out['attention_mask'] = (out['input_ids'] != pad_to).long()
+        return out
+
+    return (stack(inputs), stack(changes), pad(targets, tar_length, pad_to))
+
+
+# Lengths of old, change, new without the padding, lengths.shape = (num, 3)
+def copy_pair_lengths(data, pad_to=0):
+
+    if isinstance(data, PackedCopyPairs):
+        return data.lengths
+    nonpad = data != pad_to
+    return np.where(nonpad.any(axis=-1), data.shape[-1] - np.argmax(nonpad[..., ::-1], axis=-1), 0)
+
+
+# Batch sampler that puts copy pairs of similar length max(old, change, new) into the same batch.
+# Every epoch the pairs are shuffled, sorted by length within buckets of bucket_size batches,
+# cut into batches and the batches shuffled again. The batches are split over the ranks
+# (the same number of batches on every rank), the order only depends on seed, epoch and rank.
+class LengthBucketSampler(Sampler):
+
+    def __init__(self, lengths, batch_size, num_replicas=1, rank=0, shuffle=True, bucket_size=50, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.epoch = 0
+        num_batches = (self.lengths.shape[0] + batch_size - 1) // batch_size
+        self.num_batches = (num_batches + num_replicas - 1) // num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        # all batches of the epoch (all ranks)
+        rng = np.random.default_rng(self.seed + self.epoch)
+        key = self.lengths.max(axis=1)
+        order = rng.permutation(key.shape[0]) if self.shuffle else np.arange(key.shape[0])
+        bucket = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, order.shape[0], bucket):
+            chunk = order[start:start + bucket]
+            chunk = chunk[np.argsort(key[chunk], kind='stable')]
+            batches += [chunk[i:i + self.batch_size] for i in range(0, chunk.shape[0], self.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        # repeat batches so that every rank gets the same number of steps
+        batches += batches[:self.num_batches * self.num_replicas - len(batches)]
+        return batches
+
+    def __iter__(self):
+        for batch in self.batches()[self.rank::self.num_replicas]:
+            yield batch.tolist()
+
+    def __len__(self):
+        return self.num_batches
+
+    def padding_waste(self):
+        # fraction of [PAD] tokens in the batches of this rank in this epoch
+        # (old and change are padded to the longest of both, new to the longest new, see collate_for_COPY)
+        tokens = 0
+        padded = 0
+        for batch in self.batches()[self.rank::self.num_replicas]:
+            lengths = self.lengths[batch]
+            tokens += int(lengths.sum())
+            padded += len(batch) * (2 * int(lengths[:, :2].max()) + int(lengths[:, 2].max()))
+        return 1 - tokens / max(padded, 1)
+
+
+# Move a batch of collate_for_COPY to the device (once per batch)
+def batch_to_device(batch, device):
+    input_, change_, target_ = batch
+    input_ = {key: value.to(device, non_blocking=True) for key, value in input_.items()}
+    change_ = {key: value.to(device, non_blocking=True) for key, value in change_.items()}
+    return (input_, change_, target_.to(device, non_blocking=True))
+
+
+# Open the feature shards of a split memory-mapped
+def load_features(path, kind):
+
+    with open(path + kind + '_features.json') as f:
+        meta = json.load(f)
+    shards = [np.load(path + kind + f'_features_{s}.npy', mmap_mode='r') for s in range(meta['num_shards'])]
+
+    return shards, meta
+
+
 # Get the laws Tokenized and paddet
-def get_laws_for_Copy(path, kind):
-    
+# packed: use the packed split (pack_laws_for_Copy) if it exists
+def get_laws_for_Copy(path, kind, packed=True):
+
+    if packed and os.path.exists(path + kind + '_packed_index.npz'):
+        return PackedCopyPairs(path, kind)
+
     values = np.loadtxt(path + kind + '.txt', dtype=int)
     path = path + 'copy_pair_'
     data = []
@@ -60,3 +203,112 @@ def get_laws_for_Copy(path, kind):
     
     data = np.array(data)
     return data
+
+
+# Write a split as one contiguous uint16 file of all tokens without the padding
+# ({kind}_packed.npy) and an index with the offset and length of every old, change, new
+def pack_laws_for_Copy(path, kind, out_path=None):
+
+    out_path = path if out_path is None else out_path
+    data = get_laws_for_Copy(path, kind, packed=False)
+    assert data.max() < 2**16
+    num, _, seq_length = data.shape
+
+    # length = last non [PAD] token + 1
+    nonpad = data != 0
+    lengths = np.where(nonpad.any(axis=-1), seq_length - np.argmax(nonpad[..., ::-1], axis=-1), 0)
+    offsets = np.zeros(num * 3, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths.reshape(-1))[:-1]
+    offsets = offsets.reshape(num, 3)
+
+    tokens = np.lib.format.open_memmap(out_path + kind + '_packed.npy', mode='w+', dtype=np.uint16,
+                                       shape=(int(lengths.sum()),))
+    for i in range(num):
+        for j in range(3):
+            tokens[offsets[i, j]:offsets[i, j] + lengths[i, j]] = data[i, j, :lengths[i, j]]
+    tokens.flush()
+    np.savez(out_path + kind + '_packed_index.npz', offsets=offsets, lengths=lengths, seq_length=seq_length)
+
+
+# A packed split opened memory-mapped, pairs[idx] is the padded (3, seq_length) array
+# as in get_laws_for_Copy (the tokens are shared by all processes through the page cache)
+class PackedCopyPairs:
+
+    def __init__(self, path, kind):
+        self.tokens = np.load(path + kind + '_packed.npy', mmap_mode='r')
+        index = np.load(path + kind + '_packed_index.npz')
+        self.offsets = index['offsets']
+        self.lengths = index['lengths']
+        self.seq_length = int(index['seq_length'])
+        self.shape = (self.offsets.shape[0], 3, self.seq_length)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        pair = np.zeros((3, self.seq_length), dtype=np.int64)
+        for j in range(3):
+            start = self.offsets[idx, j]
+            pair[j, :self.lengths[idx, j]] = self.tokens[start:start + self.lengths[idx, j]]
+        return pair
+
+    def unpadded(self, idx):
+        # old, change, new as uint16 arrays without the padding
+        return tuple(np.array(self.tokens[self.offsets[idx, j]:self.offsets[idx, j] + self.lengths[idx, j]])
+                     for j in range(3))
+
+
+# Actions for the span decoder: (0, token, 0) emits a token,
+# (1, i, j) copies the positions [i, j) of cat(old, change), (-1, -1, -1) is padding
+def get_span_actions(old, change, new, min_span=4, pad_to=0):
+
+    # the laws are padded at the end, so positions in the padded arrays stay valid
+    offset_cha = old.shape[0]
+    old = old[:int((old != pad_to).sum())].tolist()
+    change = change[:int((change != pad_to).sum())].tolist()
+    # the decoder starts with [CLS], the actions cover new[1:] including [SEP]
+    new = new[1:int((new != pad_to).sum())].tolist()
+
+    def inserted(lo, hi):
+        # the parts of new that are not in old, copied from change if possible
+        actions = []
+        pos = lo
+        matcher = SequenceMatcher(None, change, new[lo:hi], autojunk=False)
+        for a, b, size in matcher.get_matching_blocks():
+            if size < min_span:
+                continue
+            actions += [(0, tok, 0) for tok in new[pos:lo + b]]
+            actions.append((1, offset_cha + a, offset_cha + a + size))
+            pos = lo + b + size
+        actions += [(0, tok, 0) for tok in new[pos:hi]]
+        return actions
+
+    actions = []
+    pos = 0
+    matcher = SequenceMatcher(None, old, new, autojunk=False)
+    for a, b, size in matcher.get_matching_blocks():
+        if size < min_span:
+            continue
+        actions += inserted(pos, b)
+        actions.append((1, a, a + size))
+        pos = b + size
+    actions += inserted(pos, len(new))
+
+    return np.array(actions, dtype=np.int64).reshape(-1, 3)
+
+
+# Span actions of a batch, padded with -1 to the longest action sequence
+def batch_span_actions(input_ids, change_ids, targets, min_span=4):
+
+    input_ids = input_ids.cpu().numpy()
+    change_ids = change_ids.cpu().numpy()
+    new_ids = targets.cpu().numpy()
+    actions = [get_span_actions(input_ids[i], change_ids[i], new_ids[i], min_span)
+               for i in range(new_ids.shape[0])]
+
+    n_actions = max(a.shape[0] for a in actions)
+    padded = np.full((len(actions), n_actions, 3), -1, dtype=np.int64)
+    for i, a in enumerate(actions):
+        padded[i, :a.shape[0]] = a
+
+    return torch.from_numpy(padded).to(targets.device)
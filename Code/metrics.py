@@ -0,0 +1,68 @@
+import numpy as np
+import torch
+
+
+class MetricsAccumulator:
+    # Training metrics without a host sync per step: the values are detached and summed up on the device,
+    # they are only copied to the host every sync_every steps (and in sync/mean).
+    # The per step values go into a preallocated ring buffer of the last capacity steps (history).
+    # width: number of values per step, e.g. 1 for the loss
+    def __init__(self, device, sync_every=50, capacity=100000, width=1):
+        self.device = device
+        self.sync_every = sync_every
+        self.width = width
+        # weighted sums of the epoch (reset), on the device
+        self.sums = torch.zeros(width, device=device)
+        self.weight = 0
+        # steps since the last sync, on the device
+        self.pending = torch.zeros((sync_every, width), device=device)
+        self.n_pending = 0
+        # ring buffer on the host
+        self.buffer = np.zeros((capacity, width), dtype=np.float32)
+        self.n_steps = 0
+        # values of the last synced step
+        self.last = np.full(width, np.nan, dtype=np.float32)
+
+    def update(self, value, weight=1):
+        # value: tensor with width elements (graph attached or not), weight: python number (e.g. batch size)
+        # returns True when the step synced (last is new)
+        value = value.detach().view(self.width).float()
+        self.sums += value * weight
+        self.weight += weight
+        self.pending[self.n_pending] = value
+        self.n_pending += 1
+        if self.n_pending == self.sync_every:
+            self.sync()
+            return True
+        return False
+
+    def sync(self):
+        # one device -> host copy of the pending steps
+        if self.n_pending == 0:
+            return
+        values = self.pending[:self.n_pending].cpu().numpy()
+        index = np.arange(self.n_steps, self.n_steps + self.n_pending) % self.buffer.shape[0]
+        self.buffer[index] = values
+        self.n_steps += self.n_pending
+        self.n_pending = 0
+        self.last = values[-1]
+
+    def mean(self):
+        # weighted mean of the epoch so far (width,)
+        self.sync()
+        return self.sums.cpu().numpy() / max(self.weight, 1)
+
+    def reset(self):
+        # new epoch, the history stays
+        self.sync()
+        self.sums.zero_()
+        self.weight = 0
+
+    def history(self):
+        # per step values in order (steps, width), at most the last capacity steps
+        self.sync()
+        capacity = self.buffer.shape[0]
+        if self.n_steps <= capacity:
+            return self.buffer[:self.n_steps].copy()
+        start = self.n_steps % capacity
+        return np.concatenate((self.buffer[start:], self.buffer[:start]))
@@ -0,0 +1,25 @@
+# Imports
+import argparse
+import time
+from lawsCOPY import pack_laws_for_Copy
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Pack the copy pairs of every split into one memory-mapped file')
+
+    parser.add_argument('--path', type=str, default='/scratch/sgutjahr/Data_Token_Copy/',
+                        help='Directory with the split files and the copy_pair_*.npy files.')
+
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'val', 'test'],
+                        help='The splits to pack.')
+
+    args = parser.parse_args()
+
+    took = time.time()
+    for kind in args.splits:
+        pack_laws_for_Copy(args.path, kind)
+        print(f'Packed {kind}', flush=True)
+
+    duration = time.time() - took
+    print(f'Took: {duration/60:.4f} min\n')
@@ -0,0 +1,104 @@
+# Imports
+import argparse
+import json
+import time
+import numpy as np
+from tqdm import tqdm
+
+import torch
+from torch.utils.data import DataLoader
+
+from lawsCOPY import get_laws_for_Copy, DatasetForCOPY, collate_for_COPY, batch_to_device
+from encoder_decoder import EncoderDecoder
+
+
+# Run the encoder once over a split and write the outputs as memory-mapped float16 shards
+# {kind}_features_{s}.npy with shape (shard_size, 2, seq_length, dim) -> [old, change]
+# checkpoint: the COPY checkpoint loaded into encoder_decoder (None -> MLM encoder), train_COPY.py loads it again
+def write_features(encoder_decoder, data, path, kind, device, batch_size=8, shard_size=1024, projected=False,
+                   checkpoint=None):
+
+    dataset = DatasetForCOPY(data)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_for_COPY)
+    num = len(dataset)
+    seq_length = data.shape[-1]
+    dim = encoder_decoder.hidden_size if projected else encoder_decoder.bert_output_size
+    num_shards = (num + shard_size - 1) // shard_size
+
+    shards = [np.lib.format.open_memmap(path + kind + f'_features_{s}.npy', mode='w+', dtype=np.float16,
+                                        shape=(min(shard_size, num - s * shard_size), 2, seq_length, dim))
+              for s in range(num_shards)]
+
+    encoder_decoder.eval()
+    idx = 0
+    with torch.no_grad():
+        for batch in tqdm(loader, desc=f'Features {kind}'):
+
+            input_,change_,target_ = batch_to_device(batch, device)
+            if projected:
+                outputs_old, outputs_cha, _, _ = encoder_decoder.encode(input_, change_)
+            else:
+                outputs_old = encoder_decoder.encoder(**input_)
+                outputs_cha = encoder_decoder.encoder(**change_)
+            # features.shape = (b, 2, batch_length, dim), the rest of a row stays 0
+            features = torch.stack((outputs_old, outputs_cha), dim=1).half().cpu().numpy()
+
+            for row in features:
+                shards[idx // shard_size][idx % shard_size, :, :row.shape[1]] = row
+                idx += 1
+
+    for shard in shards:
+        shard.flush()
+    with open(path + kind + '_features.json', 'w') as f:
+        json.dump({'num': num, 'num_shards': num_shards, 'shard_size': shard_size, 'projected': projected,
+                   'checkpoint': checkpoint}, f)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Precompute the encoder outputs for frozen-encoder training')
+
+    parser.add_argument('out_path', type=str,
+                        help='Directory for the feature shards (train_COPY.py --features).')
+
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='Fine-tuned COPY checkpoint (needed for --projected).')
+
+    parser.add_argument('--projected', action='store_true',
+                        help='Store the outputs after ff_old/ff_cha instead of the BERT outputs.')
+
+    parser.add_argument('-bs', '--batch_size', type=int, default=8,
+                        help='number of examples in a batch')
+
+    parser.add_argument('--shard_size', type=int, default=1024,
+                        help='Number of copy pairs per shard.')
+
+    parser.add_argument('--hidden_size', type=int, default=185,
+                        help='The hidden size of the GRU unit')
+
+    args = parser.parse_args()
+
+    # ff_old/ff_cha are only trained in a COPY checkpoint, without one the projection is random
+    if args.projected and args.checkpoint is None:
+        parser.error('--projected needs the fine-tuned --checkpoint')
+
+    path = '/scratch/sgutjahr/Data_Token_Copy/'
+    model_path = '/scratch/sgutjahr/log/ddp500_BERT_MLM_best.pt'
+    use_cuda = torch.cuda.is_available()
+    device = torch.device('cuda:0' if use_cuda else 'cpu')
+
+    took = time.time()
+    encoder_decoder = EncoderDecoder(model_path, device, hidden_size=args.hidden_size)
+    if args.checkpoint is not None:
+        checkpoint = torch.load(args.checkpoint, map_location=device)
+        encoder_decoder.load_state_dict(checkpoint['model_state_dict'])
+
+    for kind in ['train', 'val']:
+        data = get_laws_for_Copy(path, kind)
+        write_features(encoder_decoder, data, args.out_path, kind, device,
+                       batch_size=args.batch_size, shard_size=args.shard_size, projected=args.projected,
+                       checkpoint=args.checkpoint)
+
+    print(f'Done')
+    duration = time.time() - took
+    print(f'Took: {duration/60:.4f} min\n')
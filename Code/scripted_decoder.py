@@ -0,0 +1,89 @@
+from typing import Tuple
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class GreedyDecoder(nn.Module):
+    # The greedy loop of Decoder.forward (without targets) for torch.jit.script:
+    # only tensors and ints in the signature, the step invariant inputs come from a DecoderState,
+    # finished rows are masked instead of removed from the batch.
+    # Shares attn_W, copy_W and gru with the decoder, the embeddings are the projected table
+    # (Embedder.projected_table, rows of vocab_ids for a restricted vocab).
+    def __init__(self, decoder):
+        super(GreedyDecoder, self).__init__()
+        self.hidden_size = decoder.hidden_size
+        self.attn_W = decoder.attn_W
+        self.copy_W = decoder.copy_W
+        self.gru = decoder.gru
+
+    def forward(self, memory, input_seq, missing_token_mask, pad_column, table,
+                cls_idx: int, sep_idx: int, pad_idx: int, max_steps: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        # memory.shape = (b, 2*seq_length, hidden), input_seq.shape = (b, 2*seq_length)
+        # returns decoder_outputs (b, max_steps, n_vocab) and sampled_idxs (b, max_steps, 1) as Decoder.forward
+
+        batch_size = memory.shape[0]
+        n_vocab = missing_token_mask.shape[1]
+        hidden = memory.new_zeros((1, batch_size, self.hidden_size))
+        selective_read = memory.new_zeros((batch_size, 1, self.hidden_size))
+        sampled_idx = torch.full((batch_size, 1), cls_idx, dtype=torch.long, device=memory.device)
+        pad = torch.ones(batch_size, dtype=torch.bool, device=memory.device)
+        done = torch.zeros(batch_size, dtype=torch.bool, device=memory.device)
+
+        decoder_outputs = memory.new_zeros((batch_size, max_steps, n_vocab))
+        decoder_outputs[:, 0, cls_idx] = 1.0
+        sampled_idxs = torch.full((batch_size, max_steps, 1), pad_idx, dtype=torch.long, device=memory.device)
+        sampled_idxs[:, 0] = cls_idx
+
+        for step_idx in range(1, max_steps):
+            sampled_idx, log_probs, hidden, selective_read = self.step(sampled_idx, hidden, selective_read, table, memory,
+                                                                       input_seq, missing_token_mask, pad_column, pad)
+            # rows that emitted [SEP] before keep [PAD] and zeros
+            decoder_outputs[:, step_idx] = log_probs.masked_fill(done.unsqueeze(1), 0.0)
+            sampled_idxs[:, step_idx] = sampled_idx.masked_fill(done.unsqueeze(1), pad_idx)
+            done = done | (sampled_idx.view(-1) == sep_idx)
+            if bool(done.all()):
+                break
+
+        return decoder_outputs, sampled_idxs
+
+    def step(self, prev_idx, prev_hidden, prev_selective_read, table, memory, input_seq, missing_token_mask, pad_column,
+             pad) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        # Decoder.step with the tensors of the DecoderState
+        # -> sampled_idx (b, 1), log_probs (b, n_vocab), hidden (1, b, hidden), selective_read (b, 1, hidden)
+
+        batch_size = memory.shape[0]
+        seq_length = memory.shape[1] // 2
+
+        # ATTENTION mechanism for LAW & CHANGE
+        # attn_weights.shape = (b, 2, 1, seq_length)
+        transformed_hidden = self.attn_W(prev_hidden).view(batch_size, self.hidden_size, 1)
+        attn_scores = torch.bmm(memory, transformed_hidden).view(batch_size, 2, 1, seq_length)
+        attn_weights = F.softmax(attn_scores, dim=3)
+        # context.shape = (b, 1, 2*hidden)
+        context = torch.matmul(attn_weights, memory.view(batch_size, 2, seq_length, self.hidden_size))
+        context = context.view(batch_size, 1, 2 * self.hidden_size)
+        embedded = F.embedding(prev_idx, table)
+
+        # GRU STEP
+        gru_input = torch.cat((context, prev_selective_read, embedded), dim=2)
+        output, hidden = self.gru(gru_input, prev_hidden)
+
+        # COPY mechanism for LAW & CHANGE
+        # copy_score_seq.shape = (b, 2*seq_length, 1)
+        transformed_hidden = self.copy_W(output).view(batch_size, self.hidden_size, 1)
+        copy_score_seq = torch.bmm(memory, transformed_hidden)
+        combined_scores = copy_score_seq.new_zeros((batch_size, missing_token_mask.shape[1]))
+        combined_scores = combined_scores.scatter_add(1, input_seq, copy_score_seq.squeeze(2))
+        mask = missing_token_mask | (pad_column & pad.unsqueeze(1))
+        combined_scores = combined_scores.masked_fill(mask, -2000000.0)
+        log_probs = torch.log(F.softmax(combined_scores, dim=1) + 1e-10)
+
+        _, sampled_idx = log_probs.topk(1)
+
+        # selective read of the sampled token
+        selected_scores = (input_seq == sampled_idx).unsqueeze(2).to(copy_score_seq.dtype) * copy_score_seq
+        selected_scores_norm = F.normalize(selected_scores, p=1.0, dim=1)
+        selective_read = torch.bmm(selected_scores_norm.transpose(1, 2), memory)
+
+        return sampled_idx, log_probs, hidden, selective_read
@@ -0,0 +1,23 @@
+# Imports
+import argparse
+import time
+from encoder import save_encoder_checkpoint
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Write the encoder-only checkpoint EncoderDecoder starts from')
+
+    parser.add_argument('--model_path', type=str, default='/scratch/sgutjahr/log/ddp500_BERT_MLM_best.pt',
+                        help='MLM checkpoint of train_loop_ddp.py.')
+
+    parser.add_argument('--out_path', type=str, default='/scratch/sgutjahr/log/ddp500_BERT_encoder.safetensors',
+                        help='Slim checkpoint (*.safetensors or *.pt).')
+
+    args = parser.parse_args()
+
+    took = time.time()
+    save_encoder_checkpoint(args.model_path, args.out_path)
+    duration = time.time() - took
+    print(f'Wrote {args.out_path}')
+    print(f'Took: {duration:.2f} s\n')
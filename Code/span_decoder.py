@@ -0,0 +1,177 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from decoder import Decoder, DecoderState
+
+
+class SpanDecoder(Decoder):
+    # Decoder that emits either a single token or copies a whole span [i, j) of old or change.
+    # Actions (see lawsCOPY.get_span_actions): (0, token, 0) | (1, i, j) | (-1, -1, -1) padding,
+    # positions i, j are in cat(old, change).
+    def __init__(self, hidden_size, max_length, vocab_size, device, model_loaded, pad_to, cls_to, sep_to, mask_to,
+                 length_factor=2.0):
+        super(SpanDecoder, self).__init__(hidden_size, max_length, vocab_size, device, model_loaded,
+                                          pad_to, cls_to, sep_to, mask_to, length_factor)
+
+        # token or span
+        self.action_W = nn.Linear(self.hidden_size, 2)
+        # pointers to the first and the last position of a span
+        self.start_W = nn.Linear(self.hidden_size, self.hidden_size)
+        self.end_W = nn.Linear(self.hidden_size, self.hidden_size)
+
+
+    def forward(self, old, change, inputs_old, inputs_cha, targets=None, teacher_forcing=1.0, vocab_ids=None,
+                return_log_probs=True):
+        # with targets (the actions) returns the loss (always teacher forced) and the actions,
+        # without the greedy actions (b, steps, 3) and sampled_idxs (b, max_steps, 1) as in Decoder
+
+        batch_size = old.shape[0]
+        cls_idx = int(self.to_vocab_index(vocab_ids, self.cls_to))
+
+        # memory_ids.shape = (b, 2*seq_length) -> global token ids
+        memory_ids = torch.cat((inputs_old, inputs_cha), dim=1).long()
+        # a span never covers [PAD]
+        valid_pos = memory_ids != self.pad_to
+        max_steps = self.decode_length(inputs_old, inputs_cha)
+
+        hidden = torch.zeros(1, batch_size, self.hidden_size).to(self.device)
+        selective_read = torch.zeros(batch_size, 1, self.hidden_size).to(self.device)
+        prev_idx = torch.full((batch_size, 1), cls_idx, dtype=torch.long, device=self.device)
+        # decoder_state.memory.shape = (b, 2*seq_length, hidden)
+        decoder_state = DecoderState(self, old, change, inputs_old, inputs_cha, vocab_ids)
+        pad = torch.ones(batch_size, dtype=torch.bool, device=self.device)
+        state = (prev_idx, hidden, selective_read)
+
+        if targets is not None:
+            return self.action_loss(state, decoder_state, pad, memory_ids, valid_pos, targets)
+
+        return self.decode(state, decoder_state, pad, memory_ids, valid_pos, max_steps)
+
+
+    def action_loss(self, state, decoder_state, pad, memory_ids, valid_pos, targets):
+
+        prev_idx, hidden, selective_read = state
+        vocab_ids = decoder_state.vocab_ids
+        memory = decoder_state.memory
+        n_actions = int((targets[:, :, 0] >= 0).sum(dim=1).max())
+        loss_sum = 0.0
+
+        for t in range(n_actions):
+            # kind, a, b .shape = (b,)
+            kind, a, b = targets[:, t, 0], targets[:, t, 1], targets[:, t, 2]
+            is_token = kind == 0
+            is_span = kind == 1
+
+            log_probs, action_log_probs, start_log_probs, hidden, copy_score_seq, output = self.span_step(
+                prev_idx, hidden, decoder_state, selective_read, pad, valid_pos)
+
+            token = self.to_vocab_index(vocab_ids, torch.where(is_token, a, self.pad_to))
+            start = torch.where(is_span, a, 0)
+            end = torch.where(is_span, b - 1, 0)
+            end_log_probs = self.end_log_probs(output, memory, valid_pos, start)
+
+            # nll of the action and of its token or span
+            loss_t = -action_log_probs.gather(1, kind.clamp(min=0).unsqueeze(1)).squeeze(1) * (kind >= 0)
+            loss_t = loss_t - log_probs.gather(1, token.unsqueeze(1)).squeeze(1) * is_token
+            loss_t = loss_t - (start_log_probs.gather(1, start.unsqueeze(1)).squeeze(1)
+                               + end_log_probs.gather(1, end.unsqueeze(1)).squeeze(1)) * is_span
+            loss_sum = loss_sum + loss_t.sum()
+
+            # teacher forcing: next input is the emitted token or the last token of the span
+            last_token = torch.where(is_span, memory_ids.gather(1, end.unsqueeze(1)).squeeze(1), a.clamp(min=0))
+            prev_idx = self.to_vocab_index(vocab_ids, last_token).unsqueeze(1)
+            selective_read = self.next_selective_read(prev_idx, decoder_state, copy_score_seq, is_span, start, end)
+
+        loss = loss_sum / (targets[:, :, 0] >= 0).sum()
+        return loss, targets
+
+
+    def decode(self, state, decoder_state, pad, memory_ids, valid_pos, max_steps):
+
+        prev_idx, hidden, selective_read = state
+        batch_size = prev_idx.shape[0]
+        vocab_ids = decoder_state.vocab_ids
+        memory = decoder_state.memory
+
+        sampled_idxs = torch.full((batch_size, max_steps), self.pad_to, dtype=torch.long, device=self.device)
+        sampled_idxs[:, 0] = self.cls_to
+        lengths = [1] * batch_size
+        done = [False] * batch_size
+        actions = []
+
+        for _ in range(1, max_steps):
+
+            log_probs, action_log_probs, start_log_probs, hidden, copy_score_seq, output = self.span_step(
+                prev_idx, hidden, decoder_state, selective_read, pad, valid_pos)
+
+            kind = action_log_probs.argmax(dim=1)
+            _, token = log_probs.topk(1)
+            token = token.view(-1)
+            start = start_log_probs.argmax(dim=1)
+            end = self.end_log_probs(output, memory, valid_pos, start).argmax(dim=1)
+            is_span = kind == 1
+            token = token if vocab_ids is None else vocab_ids[token]
+            actions.append(torch.stack((kind, torch.where(is_span, start, token), torch.where(is_span, end + 1, 0)), dim=1))
+
+            # write the emitted tokens
+            for i, (k, tok, s, e) in enumerate(zip(kind.tolist(), token.tolist(), start.tolist(), end.tolist())):
+                if done[i]:
+                    continue
+                emitted = memory_ids[i, s:e + 1] if k == 1 else torch.tensor([tok], device=self.device)
+                n = min(emitted.shape[0], max_steps - lengths[i])
+                sampled_idxs[i, lengths[i]:lengths[i] + n] = emitted[:n]
+                lengths[i] += n
+                done[i] = self.sep_to in emitted[:n].tolist() or lengths[i] == max_steps
+            if all(done):
+                break
+
+            last_token = torch.where(is_span, memory_ids.gather(1, end.unsqueeze(1)).squeeze(1), token)
+            prev_idx = self.to_vocab_index(vocab_ids, last_token).unsqueeze(1)
+            selective_read = self.next_selective_read(prev_idx, decoder_state, copy_score_seq, is_span, start, end)
+
+        # cut everything after the first [SEP]
+        for i in range(batch_size):
+            sep = (sampled_idxs[i] == self.sep_to).nonzero()
+            if sep.shape[0] > 0:
+                sampled_idxs[i, int(sep[0]) + 1:] = self.pad_to
+
+        return torch.stack(actions, dim=1), sampled_idxs.unsqueeze(2)
+
+
+    def span_step(self, prev_idx, prev_hidden, decoder_state, prev_selective_read, pad, valid_pos):
+
+        memory = decoder_state.memory
+        log_probs, hidden, copy_score_seq = self.score(prev_idx, prev_hidden, decoder_state, prev_selective_read, pad)
+        # output.shape = (b, 1, hidden) -> single layer GRU, the output is the hidden state
+        output = hidden.transpose(0, 1)
+        # action_log_probs.shape = (b, 2)
+        action_log_probs = F.log_softmax(self.action_W(output).squeeze(1).float(), dim=1)
+        # start_log_probs.shape = (b, 2*seq_length)
+        start_scores = torch.bmm(memory, self.start_W(output).transpose(1, 2)).squeeze(2)
+        # masked in fp32 (autocast)
+        start_log_probs = F.log_softmax(start_scores.float().masked_fill(~valid_pos, -1000000.0), dim=1)
+
+        return log_probs, action_log_probs, start_log_probs, hidden, copy_score_seq, output
+
+
+    def end_log_probs(self, output, memory, valid_pos, start):
+        # last position of a span starting at start: not before it and in the same law (old or change)
+        seq_length = memory.shape[1] // 2
+        # start_rep.shape = (b, 1, hidden)
+        start_rep = memory.gather(1, start.view(-1, 1, 1).expand(-1, 1, memory.shape[2]))
+        end_scores = torch.bmm(memory, self.end_W(output + start_rep).transpose(1, 2)).squeeze(2)
+        pos = torch.arange(memory.shape[1], device=self.device).unsqueeze(0)
+        seg_end = torch.where(start < seq_length, seq_length, 2 * seq_length).unsqueeze(1)
+        allowed = valid_pos & (pos >= start.unsqueeze(1)) & (pos < seg_end)
+        return F.log_softmax(end_scores.float().masked_fill(~allowed, -1000000.0), dim=1)
+
+
+    def next_selective_read(self, prev_idx, decoder_state, copy_score_seq, is_span, start, end):
+        # tokens: selective read as in Decoder, spans: mean of the copied encoder outputs
+        memory = decoder_state.memory
+        token_read = self.get_selective_read(prev_idx, decoder_state, copy_score_seq)
+        pos = torch.arange(memory.shape[1], device=self.device).unsqueeze(0)
+        # span_mask.shape = (b, 1, 2*seq_length)
+        span_mask = ((pos >= start.unsqueeze(1)) & (pos <= end.unsqueeze(1))).to(memory.dtype).unsqueeze(1)
+        span_read = torch.bmm(span_mask, memory) / span_mask.sum(dim=2, keepdim=True)
+        return torch.where(is_span.view(-1, 1, 1), span_read, token_read)
@@ -1,7 +1,9 @@
 # Imports
 import argparse
+import math
 import os
 import time
+from contextlib import nullcontext
 import numpy as np
 from tqdm import tqdm
 
@@ -10,12 +12,70 @@ import torch
 from torch import optim
 import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.utils.data.distributed import DistributedSampler
 from torch.utils.data import DataLoader
 
-from lawsCOPY import get_laws_for_Copy, DatasetForCOPY
+from lawsCOPY import get_laws_for_Copy, DatasetForCOPY, DatasetForCOPYFeatures, collate_for_COPY, batch_to_device
+from lawsCOPY import batch_span_actions, copy_pair_lengths, LengthBucketSampler, load_features
 from encoder_decoder import EncoderDecoder
 from evaluate import evaluate
+from metrics import MetricsAccumulator
+
+
+def copy_loss(encoder_decoder, batch, device, args, teacher_forcing, amp_dtype):
+
+    input_,change_,target_ = batch_to_device(batch, device)
+    # encoder_decoder: with or without the DDP wrapper
+    decoder = getattr(encoder_decoder, 'module', encoder_decoder).decoder
+    # restrict the output vocab to the tokens of the batch
+    vocab_ids = None
+    if args.restrict_vocab:
+        vocab_ids = decoder.batch_vocab(input_['input_ids'], change_['input_ids'], target_)
+    with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+        if args.span:
+            # the span decoder computes its loss over the diff actions of old/change -> new
+            actions = batch_span_actions(input_['input_ids'], change_['input_ids'], target_, args.min_span)
+            loss, _ = encoder_decoder(input_,change_,actions,vocab_ids=vocab_ids)
+        else:
+            # the decoder runs as many steps as the longest target of the batch and sums up
+            # the NLL of the targets step by step ([PAD] ignored as in NLLLoss(ignore_index=0)),
+            # the (b, steps, voc_size) log_probs are never stacked
+            # output_seqs.shape: (b, steps, 1)
+            loss, output_seqs = encoder_decoder(input_,change_,target_,teacher_forcing=teacher_forcing,
+                                                vocab_ids=vocab_ids,return_log_probs=False)
+    return loss, input_['input_ids'].shape[0]
+
+
+# Largest micro batch (at most max_size) for which forward + backward of the longest copy pairs
+# fits into the GPU memory, halved on every out of memory. The same (smallest) size on all ranks.
+# encoder_decoder: the module without the DDP wrapper (no collectives while the ranks probe different sizes),
+# the all_reduce of the size is the only collective
+def find_micro_batch(encoder_decoder, dataset, lengths, device, args, amp_dtype, max_size):
+
+    longest = np.argsort(np.asarray(lengths).max(axis=1))[::-1]
+    # one teacher forcing per decoder path of the schedule, the size has to fit all of them:
+    # the parallel pass (1.0 with --parallel_tf) and the step loop (every other value)
+    paths = {args.parallel_tf and tf >= 1.0 for tf in args.schedule}
+    teacher_forcings = [1.0 if parallel else 0.5 for parallel in paths]
+    size = max(max_size, 1)
+    while size > 1:
+        batch = collate_for_COPY([dataset[i] for i in longest[:size]])
+        try:
+            for teacher_forcing in teacher_forcings:
+                loss, _ = copy_loss(encoder_decoder, batch, device, args, teacher_forcing, amp_dtype)
+                loss.backward()
+                loss = None
+                encoder_decoder.zero_grad(set_to_none=True)
+            break
+        except torch.cuda.OutOfMemoryError:
+            size //= 2
+        finally:
+            loss = None
+            encoder_decoder.zero_grad(set_to_none=True)
+            torch.cuda.empty_cache()
+
+    size = torch.tensor(size, device=device)
+    dist.all_reduce(size, op=dist.ReduceOp.MIN)
+    return int(size)
 
 
 def train(rank, args):
@@ -23,7 +83,9 @@ def train(rank, args):
     # Settings
     torch.manual_seed(args.seed)
 
-    dist.init_process_group(backend='nccl',
+    # without a GPU (e.g. decoder training from --features) one process on the CPU
+    use_cuda = torch.cuda.is_available()
+    dist.init_process_group(backend='nccl' if use_cuda else 'gloo',
                             world_size=args.world_size,
                             rank=rank)
 
@@ -33,38 +95,87 @@ def train(rank, args):
 
     data_train = get_laws_for_Copy(path, 'train')
     data_val = get_laws_for_Copy(path, 'val')
-    device = torch.device(f'cuda:{rank}')
-    encoder_decoder = EncoderDecoder(model_path, device, hidden_size=args.hidden_size)
+    device = torch.device(f'cuda:{rank}' if use_cuda else 'cpu')
+    encoder_decoder = EncoderDecoder(model_path, device, hidden_size=args.hidden_size, max_length=args.max_length,
+                                     span=args.span, length_factor=args.length_factor,
+                                     trim_padding=args.trim_padding, window_overlap=args.window_overlap,
+                                     parallel_teacher_forcing=args.parallel_tf)
+    if args.checkpoint_every > 0:
+        encoder_decoder.enable_checkpointing(args.checkpoint_every)
+
+    if args.features is not None:
+        # frozen encoder: the decoder trains from the precomputed features (precompute_COPY.py).
+        # The encoder (and ff_old/ff_cha for projected features) has to be the one that computed them,
+        # else the saved model_state_dict does not fit the features the decoder was trained on
+        _, meta = load_features(args.features, 'train')
+        _, meta_val = load_features(args.features, 'val')
+        assert 'checkpoint' in meta, 'the features do not record their checkpoint, run precompute_COPY.py again'
+        assert (meta['checkpoint'], meta['projected']) == (meta_val['checkpoint'], meta_val['projected'])
+        if meta['checkpoint'] is not None:
+            checkpoint = torch.load(meta['checkpoint'], map_location=device)
+            encoder_decoder.load_state_dict(checkpoint['model_state_dict'])
+        # the word embeddings are shared with the decoder and stay trainable
+        for name, param in encoder_decoder.encoder.BERT.named_parameters():
+            param.requires_grad_(name.startswith('embeddings.'))
+        if meta['projected']:
+            for param in list(encoder_decoder.ff_old.parameters()) + list(encoder_decoder.ff_cha.parameters()):
+                param.requires_grad_(False)
 
     # Wrap the model
-    encoder_decoder = DDP(encoder_decoder, device_ids=[rank], find_unused_parameters=True)
+    encoder_decoder = DDP(encoder_decoder, device_ids=[rank] if use_cuda else None, find_unused_parameters=True)
 
     # define optimizer
-    optimizer = optim.Adam(encoder_decoder.parameters(), lr=args.lr)
-    loss_function = torch.nn.NLLLoss(ignore_index=0)
-
-    train_dataset = DatasetForCOPY(data_train,device)
-    val_dataset = DatasetForCOPY(data_val,device)
-
-    train_sampler = DistributedSampler(train_dataset,
-                                       num_replicas=args.world_size,
-                                       rank=rank)
-
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size,
-                              shuffle=False,
-                              num_workers=0,
-                              sampler=train_sampler)
-
-    val_sampler = DistributedSampler(val_dataset,
-                                     num_replicas=args.world_size,
-                                     rank=rank)
-
-    val_loader = DataLoader(val_dataset, batch_size=args.batch_size,
-                            shuffle=False,
-                            num_workers=0,
-                            sampler=val_sampler)
-
-    loss_train = []
+    optimizer = optim.Adam([p for p in encoder_decoder.parameters() if p.requires_grad], lr=args.lr)
+
+    # mixed precision: the forward runs under autocast, the weights (and the saved state_dict) stay fp32,
+    # fp16 needs the loss scaling of the GradScaler (a no-op for bf16 and fp32)
+    amp_dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}.get(args.amp)
+    scaler = torch.cuda.amp.GradScaler(enabled=args.amp == 'fp16' and use_cuda)
+
+    if args.features is None:
+        train_dataset = DatasetForCOPY(data_train)
+        val_dataset = DatasetForCOPY(data_val)
+    else:
+        train_dataset = DatasetForCOPYFeatures(data_train,args.features,'train')
+        val_dataset = DatasetForCOPYFeatures(data_val,args.features,'val')
+
+    # gradient accumulation: the optimizer steps (and DDP reduces the gradients) every accum_steps micro batches,
+    # effective_batch_size: the micro batch is the largest that fits, accumulated up to the effective batch
+    if args.effective_batch_size > 0:
+        args.batch_size = find_micro_batch(encoder_decoder.module, train_dataset, copy_pair_lengths(data_train), device,
+                                           args, amp_dtype, args.effective_batch_size // args.world_size)
+        args.accum_steps = math.ceil(args.effective_batch_size / (args.batch_size * args.world_size))
+    print(f'Rank {rank} | micro batch_size = {args.batch_size} | accum_steps = {args.accum_steps} | '
+          f'effective batch size = {args.batch_size * args.accum_steps * args.world_size}', flush=True)
+
+    # batches of copy pairs with similar lengths -> less padding in the encoder and the decoder
+    train_sampler = LengthBucketSampler(copy_pair_lengths(data_train), args.batch_size,
+                                        num_replicas=args.world_size,
+                                        rank=rank,
+                                        bucket_size=args.bucket_size,
+                                        seed=args.seed)
+
+    train_loader = DataLoader(train_dataset, batch_sampler=train_sampler,
+                              num_workers=args.num_workers,
+                              collate_fn=collate_for_COPY,
+                              pin_memory=use_cuda,
+                              persistent_workers=args.num_workers > 0)
+
+    val_sampler = LengthBucketSampler(copy_pair_lengths(data_val), args.batch_size,
+                                      num_replicas=args.world_size,
+                                      rank=rank,
+                                      shuffle=False,
+                                      bucket_size=args.bucket_size,
+                                      seed=args.seed)
+
+    val_loader = DataLoader(val_dataset, batch_sampler=val_sampler,
+                            num_workers=args.num_workers,
+                            collate_fn=collate_for_COPY,
+                            pin_memory=use_cuda,
+                            persistent_workers=args.num_workers > 0)
+
+    # train loss per step, synced to the host every log_every steps
+    loss_train = MetricsAccumulator(device, sync_every=args.log_every, capacity=args.epochs * len(train_loader))
     loss_val = []
     stat_acc = []
 
@@ -78,41 +189,38 @@ def train(rank, args):
         encoder_decoder.train()
         train_sampler.set_epoch(epoch)
         val_sampler.set_epoch(epoch)
+        padding_waste = train_sampler.padding_waste()
         # reset statistics trackers
         t = time.time()
-        train_loss_cum = 0
-        num_samples_epoch = 0
+        loss_train.reset()
+        if use_cuda:
+            torch.cuda.reset_peak_memory_stats(device)
 
         pbar = tqdm(train_loader, desc=f'Training on GPU{rank} [{epoch}/{args.epochs}]', leave=True)
 
-        for input_,change_,target_ in pbar:
+        optimizer.zero_grad()
+        for i, batch in enumerate(pbar):
 
-            # input_,change_,target_  all ready at the device
-            batch_size = input_['input_ids'].shape[0]
-
-            optimizer.zero_grad()
-            # output_log_probs.shape = (b, max_length, voc_size)
-            # output_seqs.shape: (b, max_length, 1)
-            output_log_probs, output_seqs = encoder_decoder(input_,change_,target_,teacher_forcing=args.schedule[epoch-1])
-
-            # flattened_outputs.shape = (b * max_length, voc_size)
-            flattened_outputs = output_log_probs.view(batch_size * args.max_length, -1)
-            # target_.contiguous().view(-1).shape: (b * max_length)
-            loss = loss_function(flattened_outputs, target_.contiguous().view(-1))
-            loss.backward()
-            optimizer.step()
+            # the gradients are only reduced over the ranks in the last micro batch before a step
+            step = (i + 1) % args.accum_steps == 0 or i + 1 == len(train_loader)
+            with nullcontext() if step else encoder_decoder.no_sync():
+                loss, batch_size = copy_loss(encoder_decoder, batch, device, args, args.schedule[epoch-1], amp_dtype)
+                scaler.scale(loss / args.accum_steps).backward()
+            if step:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
 
             # keep track of train stats
-            num_samples_epoch += batch_size
-            train_loss_cum += loss * batch_size
-
-            pbar.set_postfix({'loss': f'{loss.item():.2f}'})
-            loss_train.append(loss.item())
+            if loss_train.update(loss, batch_size):
+                pbar.set_postfix({'loss': f'{loss_train.last[0]:.2f}'})
 
 
-        avg_train_loss = train_loss_cum / num_samples_epoch
+        avg_train_loss = loss_train.mean()[0]
+        peak_memory = torch.cuda.max_memory_allocated(device) / 2**30 if use_cuda else 0.0
 
-        val_loss, acc = evaluate(encoder_decoder, val_loader)
+        val_loss, acc = evaluate(encoder_decoder, val_loader, restrict_vocab=args.restrict_vocab,
+                                 span=args.span, min_span=args.min_span)
         loss_val.append(val_loss)
         stat_acc.append(acc)
         epoch_duration = time.time() - t
@@ -121,7 +229,10 @@ def train(rank, args):
         print(f'Epoch {epoch} | Rank {rank} | Duration {epoch_duration:.2f} sec\n'
               f'Avgtrain loss: {avg_train_loss:.4f}\n'
               f'Validation loss: {val_loss:.4f}\n'
-              f'accuracy_score:  {acc:.4f}\n', flush=True)
+              f'accuracy_score:  {acc:.4f}\n'
+              f'Padding waste: {padding_waste:.4f}\n'
+              f'Peak memory (train): {peak_memory:.2f} GiB | batch_size = {args.batch_size} | '
+              f'checkpoint_every = {args.checkpoint_every}\n', flush=True)
 
         if cur_low_val_eval > val_loss and epoch > 4:
             cur_low_val_eval = val_loss
@@ -132,13 +243,13 @@ def train(rank, args):
                         'loss': cur_low_val_eval}, save_path)
 
         if epoch % 2 == 0:
-            np.save(f'/scratch/sgutjahr/log/{args.model_name}_COPY_epoch_train_{rank}.npy', np.array(loss_train))
+            np.save(f'/scratch/sgutjahr/log/{args.model_name}_COPY_epoch_train_{rank}.npy', loss_train.history()[:, 0])
             np.save(f'/scratch/sgutjahr/log/{args.model_name}_COPY_epoch_val_{rank}.npy', np.array(loss_val))
             np.save(f'/scratch/sgutjahr/log/{args.model_name}_COPY_epoch_acc_{rank}.npy', np.array(stat_acc))
 
 
     print(f'Lowest validation loss: {cur_low_val_eval:.4f} in Round {best_round}')
-    np.save(f'/scratch/sgutjahr/log/{args.model_name}_COPY_train_{rank}.npy', np.array(loss_train))
+    np.save(f'/scratch/sgutjahr/log/{args.model_name}_COPY_train_{rank}.npy', loss_train.history()[:, 0])
     np.save(f'/scratch/sgutjahr/log/{args.model_name}_COPY_val_{rank}.npy', np.array(loss_val))
     np.save(f'/scratch/sgutjahr/log/{args.model_name}_COPY_acc_{rank}.npy', np.array(stat_acc))
     dist.destroy_process_group()
@@ -172,14 +283,59 @@ if __name__ == '__main__':
     parser.add_argument('--max_length', type=int, default=512,
                         help='Sequences will be padded or truncated to this size.')
 
+    parser.add_argument('--window_overlap', type=int, default=128,
+                        help='Overlap of the 512 token encoder windows of longer old/change laws.')
+
+    parser.add_argument('--length_factor', type=float, default=2.0,
+                        help='Greedy decoding (span decoder validation) runs length_factor * the longest input steps.')
+
     parser.add_argument('--seed', type=int, default=42,
                         help='Seed for spliting and loader.')
 
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help='Number of worker processes per GPU that load and pad the batches.')
+
+    parser.add_argument('--bucket_size', type=int, default=50,
+                        help='Number of batches that are sorted by length together (1 -> random batches).')
+
+    parser.add_argument('--restrict_vocab', action='store_true',
+                        help='Compute the output distribution only over the tokens of each batch.')
+
+    parser.add_argument('--trim_padding', action='store_true',
+                        help='Skip the [PAD] columns shared by all inputs of a batch in the encoder.')
+
+    parser.add_argument('--features', type=str, default=None,
+                        help='Directory with precomputed encoder outputs (precompute_COPY.py), freezes the encoder.')
+
+    parser.add_argument('--parallel_tf', action='store_true',
+                        help='Epochs with full teacher forcing run all decoder steps at once (approximated recurrence).')
+
+    parser.add_argument('--checkpoint_every', type=int, default=0,
+                        help='Recompute BERT and segments of this many decoder steps in the backward pass (0 -> off).')
+
+    parser.add_argument('--amp', type=str, default=None, choices=['bf16', 'fp16'],
+                        help='Train under autocast in bf16/fp16 (fp32 weights, fp16 with loss scaling).')
+
+    parser.add_argument('--accum_steps', type=int, default=1,
+                        help='Micro batches per optimizer step (gradient accumulation).')
+
+    parser.add_argument('--effective_batch_size', type=int, default=0,
+                        help='Pick the largest micro batch that fits and accumulate up to this batch size (0 -> off).')
+
+    parser.add_argument('--log_every', type=int, default=50,
+                        help='Steps between the copies of the train loss to the host (progress bar, saved losses).')
+
+    parser.add_argument('--span', action='store_true',
+                        help='Train the span decoder that copies whole spans of old/change.')
+
+    parser.add_argument('--min_span', type=int, default=4,
+                        help='Shortest unchanged run that becomes a span action.')
+
     args = parser.parse_args()
 
     torch.backends.cudnn.benchmark = True
 
-    args.world_size = torch.cuda.device_count()
+    args.world_size = max(torch.cuda.device_count(), 1)
     os.environ['MASTER_ADDR'] = 'localhost'
     os.environ['MASTER_PORT'] = '8888'
 
@@ -95,3 +95,9 @@ def get_seq_lengths(seqs):
 
 def contains_digit(string):
     return any(char.isdigit() for char in string)
+
+
+def synchronize(device):
+    # wait for the queued GPU kernels before reading the clock
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
@@ -2,14 +2,21 @@ import numpy as np
 import torch
 import time
 from eval import evaluate
+from metrics import MetricsAccumulator
 
 
 # Trainigs Loop for BertMLM Task
-def train_loop(model, train_loader, val_loader, optim, device, mask, checkpoint, show=1, save=40, epochs=200, name='try'):
+def train_loop(model, train_loader, val_loader, optim, device, mask, checkpoint, show=1, save=40, epochs=200, name='try',
+               log_every=50):
 
     loss_train = np.empty((epochs,))
-    loss_split = np.empty((epochs,4))
+    # one loss per GPU with nn.DataParallel (mainMLM.py), a single one otherwise
+    n_split = max(torch.cuda.device_count(), 1)
+    loss_split = np.empty((epochs,n_split))
     loss_val = np.empty((epochs,3))
+    # running sums on the device (loss and the loss of every GPU), synced every log_every steps
+    metrics = MetricsAccumulator(device, sync_every=log_every)
+    metrics_split = MetricsAccumulator(device, sync_every=log_every, width=n_split)
 
     print(f'Start finetuning model')
     best_round = 0
@@ -18,10 +25,9 @@ def train_loop(model, train_loader, val_loader, optim, device, mask, checkpoint,
 
     for epoch in range(1,epochs+1):
         # reset statistics trackers
-        train_loss_cum = 0.0
-        num_samples_epoch = 0
+        metrics.reset()
+        metrics_split.reset()
         t = time.time()
-        split = torch.empty((4,)).to(device)
 
         # Go once through the training dataset (-> epoch)
         for batch in train_loader:
@@ -46,15 +52,16 @@ def train_loop(model, train_loader, val_loader, optim, device, mask, checkpoint,
 
             # keep track of train stats
             num_samples_batch = input_ids.shape[0]
-            num_samples_epoch += num_samples_batch
-            split += outputs[0] * num_samples_batch
-            train_loss_cum += loss * num_samples_batch
+            metrics.update(loss, num_samples_batch)
+            # a scalar loss (no DataParallel) or fewer GPU losses than GPUs (small batch) count as the batch loss
+            split = outputs[0].detach().reshape(-1)
+            split = torch.cat((split, loss.detach().expand(n_split - split.shape[0])))
+            metrics_split.update(split, num_samples_batch)
 
         # average the accumulated statistics
-        avg_train_loss = train_loss_cum / num_samples_epoch
-        avg_gpu_loss = split.to('cpu') / num_samples_epoch
-        loss_train[epoch-1] = avg_train_loss.item()
-        loss_split[epoch-1] = avg_gpu_loss.detach().numpy()
+        avg_train_loss = metrics.mean()[0]
+        loss_train[epoch-1] = avg_train_loss
+        loss_split[epoch-1] = metrics_split.mean()
 
         # val_loss = val_loss, acc, f1
         val_loss, acc, f1 = evaluate(model, val_loader, device, mask)
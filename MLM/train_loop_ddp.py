@@ -1,8 +1,10 @@
 # Imports
 import os
+import math
 import time
 import argparse
 import warnings
+from contextlib import nullcontext
 
 import numpy as np
 import torch
@@ -16,11 +18,40 @@ from sklearn.model_selection import train_test_split
 
 from eval_ddp import evaluate
 from lawsMLM import get_laws
+from metrics import MetricsAccumulator
 from modelMLM import LawNetMLM, LawDatasetForMLM
 
 warnings.filterwarnings('ignore')
 
 
+# Largest micro batch (at most max_size) for which forward + backward of 512 token chunks
+# fits into the GPU memory, halved on every out of memory. The same (smallest) size on all ranks.
+# model: the module without the DDP wrapper (no collectives while the ranks probe different sizes),
+# the all_reduce of the size is the only collective
+def find_micro_batch(model, dataset, rank, amp_dtype, max_size):
+
+    size = max(max_size, 1)
+    while size > 1:
+        batch = [dataset.data[i % dataset.mod] for i in range(size)]
+        try:
+            with torch.autocast('cuda', dtype=amp_dtype, enabled=amp_dtype is not None):
+                outputs = model(torch.stack([b['input_ids'] for b in batch]).to(rank),
+                                attention_mask=torch.stack([b['attention_mask'] for b in batch]).to(rank),
+                                labels=torch.stack([b['labels'] for b in batch]).to(rank))
+                outputs[0].mean().backward()
+            break
+        except torch.cuda.OutOfMemoryError:
+            size //= 2
+        finally:
+            outputs = None
+            model.zero_grad(set_to_none=True)
+            torch.cuda.empty_cache()
+
+    size = torch.tensor(size, device=rank)
+    dist.all_reduce(size, op=dist.ReduceOp.MIN)
+    return int(size)
+
+
 def train(rank, args):
     
     # Settings
@@ -43,8 +74,20 @@ def train(rank, args):
     # define optimizer
     optim = torch.optim.Adam(model.parameters(), lr=5e-5)
 
+    # mixed precision: autocast forward, fp32 weights (saved as they are), loss scaling only for fp16
+    amp_dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}.get(args.amp)
+    scaler = torch.cuda.amp.GradScaler(enabled=args.amp == 'fp16')
+
     train_dataset = LawDatasetForMLM(train_laws, args.loader_size_tr)
 
+    # gradient accumulation: optimizer step (and allreduce) every accum_steps micro batches,
+    # effective_batch_size: the micro batch is the largest that fits, accumulated up to the effective batch
+    if args.effective_batch_size > 0:
+        args.batch_size = find_micro_batch(model.module, train_dataset, rank, amp_dtype,
+                                           args.effective_batch_size // args.world_size)
+        args.accum_steps = math.ceil(args.effective_batch_size / (args.batch_size * args.world_size))
+    print(f'GPU{rank} | micro batch_size = {args.batch_size} | accum_steps = {args.accum_steps}')
+
     train_sampler = DistributedSampler(train_dataset,
                                        num_replicas=args.world_size,
                                        rank=rank)
@@ -68,6 +111,8 @@ def train(rank, args):
     print(f'Start on GPU {rank}')
 
     loss_train = np.empty((args.epoch,))
+    # running train loss on the GPU, synced to the host every log_every steps and at the end of an epoch
+    metrics = MetricsAccumulator(rank, sync_every=args.log_every)
     val = np.empty((args.epoch,3))
     best_round = 0
     INF = 10e9
@@ -79,11 +124,11 @@ def train(rank, args):
             print(f'Epoch {epoch}')
 
         # reset statistics trackers
-        train_loss_cum = 0.0
-        num_samples_epoch = 0
+        metrics.reset()
         t = time.time()
 
-        for batch in train_loader:
+        optim.zero_grad()
+        for i, batch in enumerate(train_loader):
 
             # get batches
             input_ids = batch['input_ids'].to(rank)
@@ -92,25 +137,31 @@ def train(rank, args):
 
             model.train()
 
-            # Forward pass
-            outputs = model(input_ids, attention_mask=attention_mask, labels=labels)
+            # the gradients are only reduced in the last micro batch before a step
+            step = (i + 1) % args.accum_steps == 0 or i + 1 == len(train_loader)
+            with nullcontext() if step else model.no_sync():
+                # Forward pass
+                with torch.autocast('cuda', dtype=amp_dtype, enabled=amp_dtype is not None):
+                    outputs = model(input_ids, attention_mask=attention_mask, labels=labels)
+
+                    # loss
+                    loss = outputs[0].mean()
 
-            # loss
-            loss = outputs[0].mean()
+                # Backward
+                scaler.scale(loss / args.accum_steps).backward()
 
-            # Backward and optimize
-            optim.zero_grad()
-            loss.backward()
-            optim.step()
+            # optimize
+            if step:
+                scaler.step(optim)
+                scaler.update()
+                optim.zero_grad()
 
             # keep track of train stats
-            num_samples_batch = input_ids.shape[0]
-            num_samples_epoch += num_samples_batch
-            train_loss_cum += loss * num_samples_batch
+            metrics.update(loss, input_ids.shape[0])
 
         # average the accumulated statistics
-        avg_train_loss = train_loss_cum / num_samples_epoch
-        loss_train[epoch-1] = avg_train_loss.item()
+        avg_train_loss = metrics.mean()[0]
+        loss_train[epoch-1] = avg_train_loss
 
         # val_loss = val_loss, acc, f1
         val_loss, acc, f1 = evaluate(model, val_loader, rank, args.mask)
@@ -168,6 +219,18 @@ if __name__ == '__main__':
     parser.add_argument('--save', type=bool, default=False,
                         help='Should the model be saved.')
 
+    parser.add_argument('--accum_steps', type=int, default=1,
+                        help='Micro batches per optimizer step (gradient accumulation).')
+
+    parser.add_argument('--effective_batch_size', type=int, default=0,
+                        help='Pick the largest micro batch that fits and accumulate up to this batch size (0 -> off).')
+
+    parser.add_argument('--log_every', type=int, default=50,
+                        help='Steps between the copies of the train loss to the host.')
+
+    parser.add_argument('--amp', type=str, default=None, choices=['bf16', 'fp16'],
+                        help='Train under autocast in bf16/fp16 (fp32 weights, fp16 with loss scaling).')
+
     args = parser.parse_args()
 
     if args.checkpoint == 'dbmdz/bert-base-german-cased':